@@ -13,29 +13,62 @@
 # under the License.
 
 
+import datetime
 import itertools
-import six
+import netaddr
 from dao.common import config
 from dao.control import exceptions
+from dao.control.db import change_log
+from dao.control.db import ip_bitmap
 from dao.control.db import model as models
-from dao.control.db.session_api import get_session, Session
-from sqlalchemy import or_
+from dao.control.db import session_api
+from dao.control.db.session_api import get_session
+from sqlalchemy import and_, bindparam, func, or_
+from sqlalchemy import exc as sqla_exc
 from sqlalchemy.orm import exc as sa_exc
+from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm import joinedload
 
+try:
+    from sqlalchemy.ext import baked
+except ImportError:
+    # sqlalchemy < 1.0
+    baked = None
+
+opts = [
+    config.BoolOpt('db', 'baked_queries',
+                   default=True,
+                   help='Cache compiled SQL of frequent queries.'),
+]
+
+config.register(opts)
 CONF = config.get_config()
 
 
 class Session(object):
-    def __init__(self):
+    """
+    Session for a single Driver call. Inside session_api.unit_of_work the
+    session of the unit is returned and it is not closed on exit.
+    """
+    def __init__(self, independent=False):
+        """
+        :param independent: do not use session of the unit of work, used
+        for locks and tasks which must be committed right away
+        """
         self.session = None
+        self.independent = independent
+        self.scoped = False
 
     def __enter__(self):
-        self.session = get_session()
+        if self.independent:
+            self.session = get_session(scoped=False)
+        else:
+            self.session = get_session()
+            self.scoped = self.session is session_api.current_session()
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
+        if self.session and not self.scoped:
             self.session.close()
 
 
@@ -89,16 +122,172 @@ def model_query(model,
     return query
 
 
+def _is_integrity_error(exc):
+    """ Check if DBError is caused by violated constraint
+    :type exc: exceptions.DBError
+    :rtype: bool
+    """
+    inner = getattr(exc, 'inner_exception', None)
+    if inner is None and exc.args:
+        inner = exc.args[0]
+    return isinstance(inner, sqla_exc.IntegrityError)
+
+
+def _paginate(query, obj_cls, limit=None, after_id=None):
+    """
+    Apply keyset pagination. Objects are ordered by id, next page is
+    requested with after_id equal to id of the last object of the page.
+    :type limit: int
+    :type after_id: int
+    """
+    if limit is None and after_id is None:
+        return query
+    if after_id is not None:
+        query = query.filter(obj_cls.id > after_id)
+    query = query.order_by(obj_cls.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _subnet_bitmap(session, net):
+    """
+    Load allocation bitmap of the subnet. Subnets allocated before bitmap
+    was introduced get it built from existing ports.
+    :type net: models.Subnet
+    :rtype: ip_bitmap.IPBitmap
+    """
+    subnet = net.subnet
+    if net.ip_bitmap:
+        return ip_bitmap.IPBitmap(subnet.size, net.ip_bitmap)
+    bitmap = ip_bitmap.IPBitmap(subnet.size)
+    ips = model_query(models.Port, args=[models.Port.ip], session=session).\
+        filter_by(subnet_id=net.id)
+    for ip, in ips:
+        if ip:
+            bitmap.set(netaddr.IPAddress(ip).value - subnet.value)
+    net.ip_hint = 0
+    return bitmap
+
+
+def _query_iter(query, obj_cls=None, loads=()):
+    """
+    Iterate over query results fetching rows by portions. Portions can not
+    be used if a collection is eager loaded, all the rows are fetched then.
+    :type obj_cls: models.Base
+    :type loads: list of str
+    """
+    for load in loads:
+        _cls = obj_cls
+        for ref_name in load.split('.'):
+            prop = class_mapper(_cls).relationships[ref_name]
+            if prop.uselist:
+                return iter(query.all())
+            _cls = prop.mapper.class_
+    return iter(query.yield_per(CONF.db.yield_per))
+
+
+class QueryShape(object):
+    """
+    Parts of the query which depend only on the query shape: model, joins,
+    loads and names of the filters. Resolving them takes reflection, so they
+    are built once per shape.
+    """
+
+    def __init__(self, obj_cls, joins, loads, keys):
+        self.key = (obj_cls, tuple(joins), tuple(loads), tuple(keys))
+        self.obj_cls = obj_cls
+        self.joins = list(joins)
+        self.attrs = [(key, Driver._arg2attr(obj_cls, key)) for key in keys]
+        self.options = []
+        for load in loads:
+            load = load.split('.')
+            j_load = joinedload(load[0])
+            for field in load[1:]:
+                j_load = j_load.joinedload(field)
+            self.options.append(j_load)
+
+    def query(self, session):
+        """ Build query without filters """
+        query = model_query(self.obj_cls, session=session)
+        for join in self.joins:
+            query = query.join(join)
+        if self.options:
+            query = query.options(*self.options)
+        return query
+
+    def baked_query(self, session):
+        """ Build query with bound parameters as filters """
+        return self.query(session).filter(
+            *[attr == bindparam(self.param(key)) for key, attr in self.attrs])
+
+    @staticmethod
+    def param(key):
+        return key.replace('.', '__')
+
+
+class QueryShapeCache(object):
+    """ Cache of QueryShape objects with hit rate statistics """
+
+    def __init__(self):
+        self._shapes = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, obj_cls, joins, loads, keys):
+        """
+        :rtype: QueryShape
+        """
+        key = (obj_cls, tuple(joins), tuple(loads), tuple(keys))
+        shape = self._shapes.get(key)
+        if shape is None:
+            self.misses += 1
+            shape = QueryShape(obj_cls, joins, loads, keys)
+            self._shapes[key] = shape
+        else:
+            self.hits += 1
+        return shape
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    shapes=len(self._shapes),
+                    hit_rate=float(self.hits) / total if total else 0.0)
+
+
+_SHAPES = QueryShapeCache()
+_BAKERY = baked.bakery() if baked is not None else None
+
+
 class Driver(object):
 
     def __init__(self):
         # Patch exceptions
         sa_exc.NoResultFound = exceptions.DAONotFound
 
-    def objects_get_by(self, cls, joins, loads, **kwargs):
+    def objects_get_by(self, cls, joins, loads, limit=None, after_id=None,
+                       **kwargs):
+        cls = getattr(models, cls)
+        joins = [getattr(models, join) for join in joins]
+        if limit is None and after_id is None:
+            return self._object_get_baked(cls, joins, loads, **kwargs).all()
+        query = self._object_get_by(cls, joins, loads, **kwargs)
+        return _paginate(query, cls, limit, after_id).all()
+
+    def objects_iter_by(self, cls, joins, loads, limit=None, after_id=None,
+                        **kwargs):
+        """ Streaming version of self.objects_get_by
+        :rtype: generator of models.Base
+        """
         cls = getattr(models, cls)
         joins = [getattr(models, join) for join in joins]
-        return self._object_get_by(cls, joins, loads, **kwargs).all()
+        with Session() as session:
+            query = self._object_get_by(cls, joins, loads,
+                                        session=session, **kwargs)
+            query = _paginate(query, cls, limit, after_id)
+            for obj in _query_iter(query, cls, loads):
+                yield obj
 
     @staticmethod
     def worker_register(name, worker_url, location):
@@ -262,16 +451,27 @@ class Driver(object):
             asset.save(session)
             return asset
 
-    def assets_get_by(self, **kwargs):
+    def assets_iter_by(self, limit=None, after_id=None, **kwargs):
+        """ Streaming version of self.assets_get_by
+        :rtype: generator of models.Asset
+        """
         with Session() as session:
             r = self._object_get_by(models.Asset, [models.Rack], ['rack'],
                                     session=session, **kwargs)
-            return r.all()
+            r = _paginate(r, models.Asset, limit, after_id)
+            for asset in _query_iter(r, models.Asset, ['rack']):
+                yield asset
 
-    def asset_get_by(self, **kwargs):
+    def assets_get_by(self, limit=None, after_id=None, **kwargs):
         with Session() as session:
             r = self._object_get_by(models.Asset, [models.Rack], ['rack'],
                                     session=session, **kwargs)
+            return _paginate(r, models.Asset, limit, after_id).all()
+
+    def asset_get_by(self, **kwargs):
+        with Session() as session:
+            r = self._object_get_baked(models.Asset, [models.Rack], ['rack'],
+                                       session=session, **kwargs)
             return r.one()
 
     def subnets_get(self, rack_name, vlan=None):
@@ -290,6 +490,37 @@ class Driver(object):
         else:
             return []
 
+    def subnets_get_by_racks(self, rack_names, vlan=None):
+        """
+        Bulk version of self.subnets_get. Subnets of all the racks are
+        requested with two queries.
+        :type rack_names: list of str
+        :rtype: dict(rack_name: list of models.Subnet)
+        """
+        result = dict((name, []) for name in rack_names)
+        if not result:
+            return result
+        session = get_session()
+        query = session.query(models.Rack.name, models.SwitchInterface.net_ip)
+        query = query.select_from(models.NetworkDevice).join(
+            models.SwitchInterface,
+            models.SwitchInterface.switch_id == models.NetworkDevice.id)
+        query = query.join(models.Asset).join(models.Rack)
+        # select_from is not allowed after criterion, so filter deleted here
+        for model in (models.NetworkDevice, models.SwitchInterface,
+                      models.Asset, models.Rack):
+            query = _read_deleted_filter(query, model, False)
+        query = query.filter(models.Rack.name.in_(result.keys()),
+                             models.SwitchInterface.net_ip.isnot(None))
+        ip2racks = dict()
+        for rack_name, net_ip in query.all():
+            ip2racks.setdefault(net_ip, set()).add(rack_name)
+        # Several subnets (VLANs) might share the same network IP
+        for net in self.subnets_get_by_ips(ip2racks.keys(), vlan):
+            for rack_name in ip2racks[net.ip]:
+                result[rack_name].append(net)
+        return result
+
     @staticmethod
     def subnets_get_by_ips(ips, vlan=None):
         """
@@ -318,7 +549,7 @@ class Driver(object):
         cls = models.Subnet
         filters = dict(location=CONF.common.location)
         filters.update(kwargs)
-        return self._object_get_by(cls, [], [], **filters).all()
+        return self._object_get_baked(cls, [], [], **filters).all()
 
     def subnet_create(self, values):
         return self._create_object(models.Subnet, values)
@@ -332,7 +563,7 @@ class Driver(object):
         """
         with Session() as session:
             obj_cls = models.Rack
-            return cls._object_get_by(
+            return cls._object_get_baked(
                 obj_cls, [], ['_network_map', '_worker'],
                 session=session,
                 **kwargs).one()
@@ -459,22 +690,213 @@ class Driver(object):
         else:
             return server
 
+    @staticmethod
+    def servers_update_bulk(servers, comment=None, log=False):
+        """ Update servers within one transaction and a single flush.
+        Versions are checked with SELECT FOR UPDATE first, servers changed
+        by somebody else are not updated and reported as conflicts.
+        :type servers: list of models.Server
+        :param comment: message to be set for all the servers
+        :param log: write ChangeLog records
+        :return: updated servers, conflicting servers
+        :rtype: tuple(list of models.Server, list of models.Server)
+        """
+        if not servers:
+            return [], []
+        obj_cls = models.Server
+        updated, conflicts = [], []
+        writer = change_log.get_writer() if log else None
+        records = []
+        with Session() as session:
+            with session.begin(subtransactions=True):
+                versions = dict(
+                    model_query(obj_cls, args=[obj_cls.id, obj_cls.version],
+                                session=session).
+                    filter(obj_cls.id.in_([s.id for s in servers])).
+                    with_for_update().all())
+                for server in servers:
+                    if versions.get(server.id) != server.version:
+                        conflicts.append(server)
+                        continue
+                    if comment is not None:
+                        server.message = comment
+                    if writer is not None:
+                        records.append((server.__tablename__, server.id) +
+                                       server.get_changes())
+                    elif log:
+                        log_obj = models.ChangeLog()
+                        log_obj.type = server.__tablename__
+                        log_obj.object_id = server.id
+                        log_obj.new, log_obj.old = server.get_changes()
+                        session.add(log_obj)
+                    session.add(server)
+                    updated.append(server)
+                session.flush()
+        # Changes rolled back with the unit of work must not be logged
+        for record in records:
+            session_api.on_commit(writer.add, *record)
+        return updated, conflicts
+
     def servers_get_by_worker(self, worker, **kwargs):
         with Session() as session:
             kwargs['asset.rack.worker_id'] = worker.id
             return self.servers_get_by(session=session, **kwargs)
 
     @classmethod
-    def servers_get_by(cls, **kwargs):
+    def servers_get_by(cls, limit=None, after_id=None, **kwargs):
         """
         :param kwargs: filters joined by AND logic
+        :type limit: int
+        :param after_id: return servers with id greater than after_id
+        :type after_id: int
         :rtype: list of models.Server
         """
         with Session() as session:
             join = [models.Asset, models.Rack]
             filters = {'asset.location': CONF.common.location}
             filters.update(kwargs)
-            return cls._server_base(join, session=session, **filters).all()
+            query = cls._server_base(join, session=session, **filters)
+            return _paginate(query, models.Server, limit, after_id).all()
+
+    @classmethod
+    def servers_fields_get_by(cls, fields, **kwargs):
+        """
+        Request only specified fields of servers. Rows are not mapped to
+        objects, so it is much cheaper than servers_get_by + to_dict.
+        :param fields: server fields, dotted path for referenced objects,
+        like asset.rack.name. 'interfaces' is a list of dicts with
+        name, mac and state.
+        :type fields: list of str
+        :param kwargs: filters joined by AND logic
+        :rtype: list of dict
+        """
+        return list(cls.servers_fields_iter_by(fields, **kwargs))
+
+    @classmethod
+    def servers_fields_iter_by(cls, fields, limit=None, after_id=None,
+                               **kwargs):
+        """ Streaming version of self.servers_fields_get_by. Rows are
+        fetched by db.yield_per portions, interfaces are requested for
+        every portion.
+        :rtype: generator of dict
+        """
+        obj_cls = models.Server
+        filters = {'asset.location': CONF.common.location}
+        filters.update(kwargs)
+        columns = [f for f in fields if f != 'interfaces']
+        with Session() as session:
+            query = model_query(
+                obj_cls, session=session,
+                args=[obj_cls.id] + [cls._arg2attr(obj_cls, f)
+                                     for f in columns])
+            query = query.join(models.Asset).join(models.Rack)
+            refs = set(k.split('.', 1)[0] for k in columns + filters.keys()
+                       if '.' in k)
+            if 'cluster' in refs:
+                query = query.outerjoin(
+                    models.Cluster, obj_cls.cluster_id == models.Cluster.id)
+            if 'sku' in refs:
+                query = query.outerjoin(
+                    models.Sku, obj_cls.sku_id == models.Sku.id)
+            for key, value in filters.items():
+                if key.startswith('interfaces.'):
+                    if_cls = models.ServerInterface
+                    sub = model_query(if_cls, args=[if_cls.server_id],
+                                      session=session)
+                    attr = getattr(if_cls, key.split('.', 1)[1])
+                    value = value if isinstance(value, list) else [value]
+                    sub = sub.filter(attr.in_(value)).subquery()
+                    query = query.filter(obj_cls.id.in_(sub))
+                    continue
+                attr = cls._arg2attr(obj_cls, key)
+                if isinstance(value, list):
+                    query = query.filter(attr.in_(value))
+                else:
+                    query = query.filter(attr == value)
+            query = _paginate(query, obj_cls, limit, after_id)
+            rows = _query_iter(query)
+            while True:
+                chunk = list(itertools.islice(rows, CONF.db.yield_per))
+                if not chunk:
+                    break
+                sid2ifs = dict()
+                if 'interfaces' in fields:
+                    sid2ifs = cls._server_interfaces_brief(
+                        session, [row[0] for row in chunk])
+                for row in chunk:
+                    item = dict(zip(columns, row[1:]))
+                    if 'interfaces' in fields:
+                        item['interfaces'] = sid2ifs.get(row[0], [])
+                    yield item
+
+    @staticmethod
+    def _server_interfaces_brief(session, server_ids):
+        """
+        :rtype: dict(server_id: list of dict(name, mac, state))
+        """
+        result = dict()
+        if not server_ids:
+            return result
+        if_cls = models.ServerInterface
+        query = model_query(if_cls,
+                            args=[if_cls.server_id, if_cls.name,
+                                  if_cls.mac, if_cls.state],
+                            session=session)
+        query = query.filter(if_cls.server_id.in_(server_ids))
+        for sid, name, mac, state in query.order_by(if_cls.id):
+            result.setdefault(sid, []).append(
+                dict(name=name, mac=mac, state=state))
+        return result
+
+    @staticmethod
+    def servers_get_for_check(worker, statuses):
+        """
+        Request fields used by worker periodic check for all the servers of
+        the worker with a single query.
+        :type worker: models.Worker
+        :type statuses: list of str
+        :rtype: list of tuples(id, lock_id, status, meta, rack_name)
+        """
+        cls = models.Server
+        query = model_query(cls, args=[cls.id, cls.lock_id,
+                                       cls.status, cls.meta,
+                                       models.Rack.name])
+        query = query.join(models.Asset).join(models.Rack)
+        return query.filter(models.Rack.worker_id == worker.id,
+                            cls.status.in_(statuses)).all()
+
+    @staticmethod
+    def servers_count_by_status(request_id, location):
+        """
+        Count servers processed within the request per status, including
+        the ones request is finished for.
+        :type request_id: str
+        :type location: str
+        :rtype: dict
+        """
+        cls = models.Server
+        query = model_query(cls, args=[cls.status, func.count(cls.id)])
+        query = query.join(models.Asset).join(models.Rack).filter(
+            models.Rack.location == location,
+            cls.request_id == request_id).group_by(cls.status)
+        return dict(query.all())
+
+    @staticmethod
+    def servers_brief_get_by_clusters(cluster_ids):
+        """
+        Request brief server info for all the servers of the clusters
+        with a single query.
+        :type cluster_ids: list of int
+        :rtype: list of tuples(cluster_id, name, serial, status)
+        """
+        if not cluster_ids:
+            return []
+        cls = models.Server
+        query = model_query(cls, args=[cls.cluster_id, cls.name,
+                                       models.Asset.serial, cls.status])
+        query = query.join(models.Asset)
+        query = query.filter(cls.cluster_id.in_(cluster_ids))
+        return query.order_by(cls.cluster_id, cls.id).all()
 
     @classmethod
     def servers_get_by_cluster(cls, cluster):
@@ -494,15 +916,19 @@ class Driver(object):
         filters = {'asset.location': CONF.common.location}
         filters.update(kwargs)
         with Session() as session:
-            return cls._server_base(join, session=session, **filters).one()
+            return cls._server_base(join, bake=True, session=session,
+                                    **filters).one()
 
     @classmethod
-    def _server_base(cls, join, **kwargs):
+    def _server_base(cls, join, bake=False, **kwargs):
+        """
+        :param bake: use baked query, result can not be extended then
+        """
         if [k for k in kwargs.keys() if k.startswith('interfaces.')]:
             join.append(models.ServerInterface)
         load = ['asset.rack._network_map', '_interfaces', 'cluster']
-        r = cls._object_get_by(models.Server,
-                               join, load, **kwargs)
+        get_by = cls._object_get_baked if bake else cls._object_get_by
+        r = get_by(models.Server, join, load, **kwargs)
         return r
 
     @staticmethod
@@ -523,7 +949,7 @@ class Driver(object):
         :param kwargs: filters joined by AND logic
         :rtype: list of models.PxEBoot
         """
-        return cls._object_get_by(models.PxEBoot, [], [], **kwargs).all()
+        return cls._object_get_baked(models.PxEBoot, [], [], **kwargs).all()
 
     @classmethod
     def pxe_boot_one(cls, **kwargs):
@@ -531,7 +957,7 @@ class Driver(object):
         :param kwargs: filters joined by AND logic
         :rtype: models.PxEBoot
         """
-        return cls._object_get_by(models.PxEBoot, [], [], **kwargs).one()
+        return cls._object_get_baked(models.PxEBoot, [], [], **kwargs).one()
 
     @classmethod
     def pxe_boot_create(cls, serial, lock_id):
@@ -548,55 +974,332 @@ class Driver(object):
             pxe_boot.save(session)
             return pxe_boot
 
-    def change_log(self, obj_type, obj_id):
+    @staticmethod
+    def task_create(server, action):
+        """ Create task to be processed by worker the server belongs to.
+        Task which is not finished yet is reused if the server is
+        dispatched again under the same lock_id.
+        :type server: models.Server
+        :type action: str
+        :rtype: models.Task
+        """
+        obj_cls = models.Task
+        with Session() as session:
+            task = model_query(obj_cls, session=session).filter(
+                obj_cls.server_id == server.id,
+                obj_cls.lock_id == server.lock_id,
+                obj_cls.action == action,
+                obj_cls.state.in_(['Pending', 'Running'])).first()
+            if task is not None:
+                return task
+            task = obj_cls()
+            task.action = action
+            task.server_id = server.id
+            task.lock_id = server.lock_id
+            task.worker_id = server.asset.rack.worker_id
+            task.state = 'Pending'
+            task.attempts = 0
+            task.save(session)
+            return task
+
+    @classmethod
+    def tasks_claim(cls, worker, owner, lease, limit=None, racks=None):
+        """ Claim pending tasks of the worker and tasks with expired lease.
+        :type worker: models.Worker
+        :param owner: unique name of the worker process
+        :param lease: lease time in seconds
+        :type limit: int
+        :param racks: claim tasks only for servers of these racks
+        :type racks: list of str
+        :rtype: list of models.Task
+        """
+        obj_cls = models.Task
+        now = datetime.datetime.utcnow()
+        with Session(independent=True) as session:
+            query = model_query(obj_cls, session=session).filter(
+                obj_cls.worker_id == worker.id,
+                or_(obj_cls.state == 'Pending',
+                    and_(obj_cls.state == 'Running',
+                         obj_cls.lease_expires < now)))
+            if racks is not None:
+                if not racks:
+                    return []
+                query = query.join(
+                    models.Server,
+                    models.Server.id == obj_cls.server_id).join(
+                    models.Asset).join(models.Rack).filter(
+                    models.Rack.name.in_(racks))
+            tasks = query.order_by(obj_cls.id).limit(limit).all()
+            return [task for task in tasks
+                    if cls._task_take(session, task, owner, lease)]
+
+    @classmethod
+    def task_claim_for(cls, server_id, lock_id, action, owner, lease):
+        """ Claim pending task for specific server.
+        :rtype: models.Task
+        """
+        obj_cls = models.Task
+        with Session(independent=True) as session:
+            task = model_query(obj_cls, session=session).filter_by(
+                server_id=server_id, lock_id=lock_id, action=action).\
+                order_by(obj_cls.id.desc()).first()
+            if task is None:
+                raise exceptions.DAONotFound('No {0} task for {1}'.
+                                             format(action, server_id))
+            if task.state != 'Pending' or \
+                    not cls._task_take(session, task, owner, lease):
+                raise exceptions.DAOConflict('Task {0} is {1}'.
+                                             format(task.id, task.state))
+            return task
+
+    @staticmethod
+    def _task_take(session, task, owner, lease):
+        """ Take task using conditional update, so only one worker process
+        wins the task.
+        :rtype: bool
+        """
+        obj_cls = models.Task
+        expires = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=lease)
+        count = model_query(obj_cls, session=session).filter(
+            obj_cls.id == task.id,
+            obj_cls.state == task.state,
+            obj_cls.attempts == task.attempts).update(
+                {'state': 'Running',
+                 'owner': owner,
+                 'attempts': task.attempts + 1,
+                 'lease_expires': expires},
+                synchronize_session=False)
+        if count:
+            session.refresh(task)
+        return bool(count)
+
+    @staticmethod
+    def task_extend(task, lease):
+        """ Extend lease of the running task
+        :type task: models.Task
+        :param lease: lease time in seconds
+        :rtype: models.Task
+        """
+        task.lease_expires = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=lease)
+        with Session(independent=True) as session:
+            task.save(session)
+            return task
+
+    @staticmethod
+    def task_finish(task, state, message=''):
+        """
+        :type task: models.Task
+        :param state: Done or Failed
+        :type message: str
+        :rtype: models.Task
+        """
+        task.state = state
+        task.message = message[-255:] if message else message
+        task.lease_expires = None
+        with Session(independent=True) as session:
+            task.save(session)
+            return task
+
+    @staticmethod
+    def task_requeue(task, message=''):
+        """ Return failed task to the queue to be claimed again
+        :type task: models.Task
+        :type message: str
+        :rtype: models.Task
+        """
+        task.state = 'Pending'
+        task.owner = None
+        task.message = message[-255:] if message else message
+        task.lease_expires = None
+        with Session(independent=True) as session:
+            task.save(session)
+            return task
+
+    @staticmethod
+    def server_lock_acquire(server_id, owner, lease):
+        """ Acquire lease based lock of the server. Lock held by other owner
+        is taken over only if it is expired.
+        :type server_id: int
+        :param owner: unique name of the worker process
+        :param lease: lease time in seconds
+        :raises: exceptions.DAOConflict if server is locked
+        """
+        obj_cls = models.ServerLock
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=lease)
+        with Session(independent=True) as session:
+            count = model_query(obj_cls, session=session).filter(
+                obj_cls.server_id == server_id,
+                obj_cls.expires < now).update(
+                    {'owner': owner,
+                     'expires': expires,
+                     'heartbeat_at': now},
+                    synchronize_session=False)
+            if count:
+                return
+            lock = obj_cls()
+            lock.server_id = server_id
+            lock.owner = owner
+            lock.expires = expires
+            lock.heartbeat_at = now
+            try:
+                lock.save(session)
+            except exceptions.DBError, exc:
+                if not _is_integrity_error(exc):
+                    raise
+                # Unique index on server_id is violated
+                raise exceptions.DAOConflict('Server {0} is locked'.
+                                             format(server_id))
+
+    @staticmethod
+    def server_lock_release(server_id, owner):
+        """
+        :type server_id: int
+        :param owner: unique name of the worker process
+        """
+        obj_cls = models.ServerLock
+        with Session(independent=True) as session:
+            model_query(obj_cls, session=session).filter(
+                obj_cls.server_id == server_id,
+                obj_cls.owner == owner).delete(synchronize_session=False)
+
+    @staticmethod
+    def server_locks_extend(server_ids, owner, lease):
+        """ Heartbeat locks held by owner
+        :type server_ids: list of int
+        :param owner: unique name of the worker process
+        :param lease: lease time in seconds
+        :return: number of locks extended
+        :rtype: int
+        """
+        if not server_ids:
+            return 0
+        obj_cls = models.ServerLock
+        now = datetime.datetime.utcnow()
+        with Session(independent=True) as session:
+            return model_query(obj_cls, session=session).filter(
+                obj_cls.server_id.in_(server_ids),
+                obj_cls.owner == owner).update(
+                    {'expires': now + datetime.timedelta(seconds=lease),
+                     'heartbeat_at': now},
+                    synchronize_session=False)
+
+    def change_log(self, obj_type, obj_id, limit=None, after_id=None):
         """
         Request change log from DB
         :param obj_type: Name of the DB object to inspect changes
         :type obj_type: str
         :param obj_id: key of the object to inspect changes
         :type obj_id: str
+        :type limit: int
+        :type after_id: int
         :rtype: list of dao.control.db.model.ChangeLog
         """
         args = dict(type=obj_type)
         if obj_id:
             args['object_id'] = obj_id
 
-        return self._object_get_by(models.ChangeLog, [], [], **args).all()
+        query = self._object_get_by(models.ChangeLog, [], [], **args)
+        return _paginate(query, models.ChangeLog, limit, after_id).all()
 
-    def ports_list(self, **kwargs):
+    def ports_list(self, limit=None, after_id=None, **kwargs):
         """
         Request ports from DB
         :param kwargs: filters
         :type kwargs: dict
+        :type limit: int
+        :type after_id: int
         :rtype: list of dao.control.db.model.Port
         """
-        return self._object_get_by(models.Port, [], [], **kwargs).all()
+        query = self._object_get_by(models.Port, [], [], **kwargs)
+        return _paginate(query, models.Port, limit, after_id).all()
 
     @staticmethod
-    def port_create(rack_name, device_id, vlan_tag, mac, ip, subnet_id):
-        """ Create new port record
+    def ports_allocate(rack_name, requests):
+        """ Create port records with the lowest free IPs of the subnets.
+        Subnet rows are locked and their allocation bitmaps are updated
+        within the same transaction ports are created in.
         :type rack_name: str
-        :type device_id: str
-        :type vlan_tag: int
-        :type mac: str
-        :type ip: str
-        :type subnet_id: int
-        :rtype: dao.control.db.model.Port
+        :param requests: (device_id, subnet_id, mac, first, last, ip) for
+        every port. IP is taken from [first, last) offsets of the subnet
+        unless ip is set.
+        :type requests: list of tuple
+        :rtype: list of dao.control.db.model.Port
         """
-        with Session() as session:
-            ports = model_query(models.Port, session=session).\
-                filter_by(ip=ip).all()
-            if ports:
-                raise exceptions.DAOConflict('Port for ip %r exists' % ip)
-            p = models.Port()
-            p.device_id = device_id
-            p.rack_name = rack_name
-            p.vlan_tag = vlan_tag
-            p.ip = ip
-            p.mac = mac
-            p.subnet_id = subnet_id
-            p.save(session=session)
-            return p
+        if not requests:
+            return []
+        subnet_ids = set(r[1] for r in requests)
+        ports = []
+        # Commit right away to not keep subnet rows locked
+        with Session(independent=True) as session:
+            with session.begin():
+                # Lock subnets in the same order to avoid deadlocks
+                nets = model_query(models.Subnet, session=session).\
+                    filter(models.Subnet.id.in_(subnet_ids)).\
+                    order_by(models.Subnet.id).with_for_update().all()
+                nets = dict((net.id, net) for net in nets)
+                missing = subnet_ids.difference(nets)
+                if missing:
+                    raise exceptions.DAONotFound(
+                        'Subnets not found: %r' % sorted(missing))
+                bitmaps = dict((net.id, _subnet_bitmap(session, net))
+                               for net in nets.values())
+                for device_id, subnet_id, mac, first, last, ip in requests:
+                    net = nets[subnet_id]
+                    bitmap = bitmaps[subnet_id]
+                    base = net.subnet.value
+                    if ip:
+                        offset = netaddr.IPAddress(ip).value - base
+                        if not 0 <= offset < bitmap.size:
+                            raise exceptions.DAOException(
+                                'IP %r is out of subnet %r' % (ip, net.name))
+                        if offset in bitmap:
+                            raise exceptions.DAOConflict(
+                                'Port for ip %r exists' % ip)
+                    else:
+                        offset = bitmap.find_free(
+                            max(net.ip_hint or 0, first), last)
+                        if offset is None:
+                            raise exceptions.DAOException(
+                                'No free IP left in subnet %r' % net.name)
+                        ip = str(netaddr.IPAddress(base + offset))
+                        net.ip_hint = offset + 1
+                    bitmap.set(offset)
+                    p = models.Port()
+                    p.device_id = device_id
+                    p.rack_name = rack_name
+                    p.vlan_tag = net.vlan_tag
+                    p.ip = ip
+                    p.mac = mac
+                    p.subnet_id = subnet_id
+                    session.add(p)
+                    ports.append(p)
+                for net in nets.values():
+                    net.ip_bitmap = bitmaps[net.id].dumps()
+                    session.add(net)
+                session.flush()
+        return ports
+
+    @staticmethod
+    def port_release(port):
+        """ Soft delete port and return its IP to the subnet
+        :type port: dao.control.db.model.Port
+        :rtype: None
+        """
+        with Session(independent=True) as session:
+            with session.begin():
+                net = model_query(models.Subnet, session=session).\
+                    filter_by(id=port.subnet_id).with_for_update().one()
+                bitmap = _subnet_bitmap(session, net)
+                offset = netaddr.IPAddress(port.ip).value - net.subnet.value
+                bitmap.clear(offset)
+                net.ip_bitmap = bitmap.dumps()
+                net.ip_hint = min(net.ip_hint or 0, offset)
+                session.add(net)
+                model_query(models.Port, session=session).\
+                    filter_by(id=port.id).one().soft_delete(session)
 
     @staticmethod
     def object_get(object_type, key, key_value):
@@ -618,13 +1321,21 @@ class Driver(object):
 
     @staticmethod
     def update(obj, log=False):
+        writer = change_log.get_writer() if log else None
         with Session() as session:
+            if writer is not None:
+                new, old = obj.get_changes()
+                obj.save(session)
+                # Changes rolled back with the unit of work must not be logged
+                session_api.on_commit(writer.add, obj.__tablename__, obj.id,
+                                      new, old)
+                return obj
             if log:
                 log_obj = models.ChangeLog()
                 log_obj.type = obj.__tablename__
                 log_obj.object_id = obj.id
                 log_obj.new, log_obj.old = obj.get_changes()
-                log_obj.save()
+                log_obj.save(session)
             obj.save(session)
             return obj
 
@@ -647,7 +1358,7 @@ class Driver(object):
         :rtype: None
         """
         session = get_session()
-        with session.begin():
+        with session.begin(subtransactions=True):
             if soft:
                 obj.soft_delete(session)
             else:
@@ -660,6 +1371,21 @@ class Driver(object):
         obj.save()
         return obj
 
+    @staticmethod
+    def _arg2attr(obj_cls, arg):
+        """
+        Resolve dotted path like asset.rack.name to the model attribute
+        :type arg: str
+        """
+        arg = arg.split('.')
+        _cls = obj_cls
+        for ref_name in arg[:-1]:
+            attr = getattr(_cls, ref_name)
+            if isinstance(attr, property):
+                attr = getattr(_cls, '_' + ref_name)
+            _cls = attr.property.mapper.class_
+        return getattr(_cls, arg[-1])
+
     @classmethod
     def _object_get_by(cls, obj_cls, joins, loads, **kwargs):
         """
@@ -667,31 +1393,40 @@ class Driver(object):
         @type joins: list of BaseModel
         @type loads: list of strings
         """
-        def arg2arg(_arg, _value):
-            _arg = _arg.split('.')
-            _cls = obj_cls
-            for _ref_name in _arg[:-1]:
-                attr = getattr(_cls, _ref_name)
-                if isinstance(attr, property):
-                    attr = getattr(_cls, '_' + _ref_name)
-                _cls = attr.property.mapper.class_
-            _attr = getattr(_cls, _arg[-1])
-            if isinstance(_value, list):
-                return _attr.in_(_value)
-            else:
-                return _attr == _value
-        # Generate base query
-        query = model_query(obj_cls, session=kwargs.pop('session', None))
-        # Apply joins
-        for join in joins:
-            query = query.join(join)
-        # Apply joined loads one by one
-        for load in loads:
-            load = load.split('.')
-            j_load = joinedload(load[0])
-            for field in load[1:]:
-                j_load = j_load.joinedload(field)
-            query = query.options(j_load)
+        session = kwargs.pop('session', None)
+        keys = sorted(kwargs.keys())
+        shape = _SHAPES.get(obj_cls, joins, loads, keys)
+        query_arg = [attr.in_(kwargs[key])
+                     if isinstance(kwargs[key], list) else
+                     attr == kwargs[key]
+                     for key, attr in shape.attrs]
+        return shape.query(session).filter(*query_arg)
 
-        query_arg = [arg2arg(k, v) for k, v in six.iteritems(kwargs)]
-        return query.filter(*query_arg)
+    @classmethod
+    def _object_get_baked(cls, obj_cls, joins, loads, **kwargs):
+        """
+        The same as self._object_get_by, but compiled SQL is cached per
+        query shape and only parameters are bound per call. The result
+        supports all(), one() and first() only, so it can not be used if
+        the query is extended by the caller.
+        Falls back to self._object_get_by for list filters (IN clause size
+        is a part of SQL), None filters (IS NULL can not be bound) or if
+        baked queries are disabled.
+        """
+        if (_BAKERY is None or not CONF.db.baked_queries or
+                [v for v in kwargs.values()
+                 if v is None or isinstance(v, list)]):
+            return cls._object_get_by(obj_cls, joins, loads, **kwargs)
+        session = kwargs.pop('session', None) or get_session()
+        keys = sorted(kwargs.keys())
+        shape = _SHAPES.get(obj_cls, joins, loads, keys)
+        query = _BAKERY(shape.baked_query, shape.key)
+        return query(session).params(
+            **dict((shape.param(k), v) for k, v in kwargs.items()))
+
+    @staticmethod
+    def query_cache_stats():
+        """ Return statistics of query shape cache
+        :rtype: dict
+        """
+        return _SHAPES.stats()
@@ -0,0 +1,142 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import datetime
+import threading
+import time
+import traceback
+
+from sqlalchemy import and_, or_, select, MetaData, Table
+
+from dao.common import config
+from dao.common import log
+from dao.control.db import model as models
+from dao.control.db import session_api
+
+
+opts = [
+    config.IntOpt('db', 'archive_interval',
+                  default=0,
+                  help='Interval in hours between runs of archiving of soft '
+                       'deleted rows by master. 0 disables archiving.'),
+
+    config.IntOpt('db', 'archive_days',
+                  default=30,
+                  help='Rows deleted (change log rows created) more than '
+                       'this number of days ago are archived.'),
+
+    config.IntOpt('db', 'archive_batch_size',
+                  default=1000,
+                  help='Number of rows moved to shadow table in one '
+                       'transaction.'),
+
+    config.BoolOpt('db', 'archive_change_log',
+                   default=False,
+                   help='Archive change log rows by age. History of the '
+                        'objects returned by API is truncated then.'),
+]
+
+config.register(opts)
+CONF = config.get_config()
+LOG = log.getLogger(__name__)
+
+# Tables having shadow_<name> table, see migration 010
+TABLES = ['port', 'server_interface', 'switch_interface', 'pxe_boot',
+          'change_log', 'task']
+
+
+def _archive_filter(table, cutoff):
+    """ Condition of rows to be archived """
+    deleted = and_(table.c.deleted != 0, table.c.deleted_at < cutoff)
+    if table.name == 'change_log':
+        # Change log is never deleted, it is archived by age
+        return table.c.created_at < cutoff
+    elif table.name == 'task':
+        return or_(deleted,
+                   and_(table.c.state.in_(['Done', 'Failed']),
+                        table.c.updated_at < cutoff))
+    return deleted
+
+
+def _archive_batch(engine, table, shadow, cutoff, batch_size):
+    """ Move one batch of rows to shadow table within short transaction.
+    :return: number of rows moved
+    :rtype: int
+    """
+    with engine.begin() as conn:
+        ids = [row[0] for row in conn.execute(
+            select([table.c.id]).where(_archive_filter(table, cutoff)).
+            order_by(table.c.id).limit(batch_size))]
+        if not ids:
+            return 0
+        columns = [c.name for c in table.columns]
+        conn.execute(shadow.insert().from_select(
+            columns,
+            select([table.c[c] for c in columns]).
+            where(table.c.id.in_(ids))))
+        conn.execute(table.delete().where(table.c.id.in_(ids)))
+        return len(ids)
+
+
+def archive_deleted_rows(days=None, batch_size=None, tables=None):
+    """ Move soft deleted rows older than days to shadow tables.
+    Rows are moved by batches, so tables are not locked for long.
+    :type days: int
+    :type batch_size: int
+    :param tables: names of tables to archive, all by default (change_log
+    only if db.archive_change_log is set)
+    :return: number of archived rows per table
+    :rtype: dict
+    """
+    days = CONF.db.archive_days if days is None else days
+    batch_size = batch_size or CONF.db.archive_batch_size
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    engine = session_api.get_engine()
+    meta = MetaData(bind=engine)
+    result = dict()
+    if not tables:
+        tables = [name for name in TABLES
+                  if name != 'change_log' or CONF.db.archive_change_log]
+    for name in tables:
+        table = models.Base.metadata.tables[name]
+        shadow = Table('shadow_' + name, meta, autoload=True)
+        result[name] = 0
+        while True:
+            count = _archive_batch(engine, table, shadow, cutoff, batch_size)
+            result[name] += count
+            if count < batch_size:
+                break
+        LOG.info('Archived %s rows of %s', result[name], name)
+    return result
+
+
+def run_periodic():
+    """ Archive rows every db.archive_interval hours, runs forever """
+    while True:
+        time.sleep(CONF.db.archive_interval * 3600)
+        try:
+            archive_deleted_rows()
+        except Exception:
+            LOG.warning(traceback.format_exc())
+
+
+def start_periodic():
+    """ Start archiving thread if db.archive_interval is set """
+    if CONF.db.archive_interval <= 0:
+        return None
+    thread = threading.Thread(target=run_periodic)
+    thread.daemon = True
+    thread.start()
+    return thread
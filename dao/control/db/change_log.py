@@ -0,0 +1,154 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import atexit
+import datetime
+import os
+import threading
+from eventlet import semaphore
+
+from dao.common import config
+from dao.common import log
+from dao.control.db import model as models
+from dao.control.db import session_api
+
+
+opts = [
+    config.BoolOpt('db', 'change_log_async',
+                   default=False,
+                   help='Write change log records in background by batches.'),
+
+    config.IntOpt('db', 'change_log_batch',
+                  default=100,
+                  help='Number of buffered change log records which triggers '
+                       'flush.'),
+
+    config.IntOpt('db', 'change_log_interval',
+                  default=5,
+                  help='Maximum time in seconds change log record is kept '
+                       'in memory.'),
+
+    config.IntOpt('db', 'change_log_max_buffer',
+                  default=10000,
+                  help='Maximum number of change log records kept in memory '
+                       'while DB is not available. The oldest records are '
+                       'dropped.'),
+]
+
+config.register(opts)
+CONF = config.get_config()
+LOG = log.getLogger(__name__)
+
+_WRITER = None
+# Created on import, before monkey patching, so green one is used explicitly
+_WRITER_LOCK = semaphore.Semaphore()
+
+
+class ChangeLogWriter(object):
+    """
+    Write-behind writer for ChangeLog records. Records are buffered and
+    inserted with a single statement when buffer reaches batch size or
+    by timer. Pending records are flushed on stop and on process exit.
+    """
+
+    def __init__(self, batch, interval, max_buffer):
+        self.batch = batch
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.pid = os.getpid()
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def add(self, obj_type, object_id, new, old):
+        """ Buffer change log record
+        :type obj_type: str
+        :type object_id: int
+        :type new: dict
+        :type old: dict
+        """
+        record = dict(type=obj_type, object_id=object_id, new=new, old=old,
+                      created_at=datetime.datetime.utcnow(), deleted=0)
+        with self._lock:
+            self._buffer.append(record)
+            full = len(self._buffer) >= self.batch
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """ Write all buffered records """
+        with self._lock:
+            records, self._buffer = self._buffer, []
+        if not records:
+            return
+        session = session_api.get_session(scoped=False)
+        try:
+            session.execute(models.ChangeLog.__table__.insert(), records)
+        except Exception:
+            LOG.exception('Unable to write %s change log records',
+                          len(records))
+            # Keep records for the next attempt
+            with self._lock:
+                self._buffer[:0] = records
+                dropped = len(self._buffer) - self.max_buffer
+                if dropped > 0:
+                    del self._buffer[:dropped]
+            if dropped > 0:
+                LOG.warning('Change log buffer is full, %s records dropped',
+                            dropped)
+        finally:
+            session.close()
+
+    def stop(self):
+        """ Stop background thread and flush pending records """
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+def get_writer():
+    """ Return process wide writer if asynchronous change log is enabled
+    :rtype: ChangeLogWriter
+    """
+    global _WRITER
+    if not CONF.db.change_log_async:
+        return None
+    with _WRITER_LOCK:
+        # Writer thread does not survive fork
+        if _WRITER is None or _WRITER.pid != os.getpid():
+            _WRITER = ChangeLogWriter(CONF.db.change_log_batch,
+                                      CONF.db.change_log_interval,
+                                      CONF.db.change_log_max_buffer)
+    return _WRITER
+
+
+def stop():
+    """ Flush pending records, e.g. before fork or shutdown """
+    global _WRITER
+    with _WRITER_LOCK:
+        writer, _WRITER = _WRITER, None
+    if writer is not None:
+        writer.stop()
@@ -0,0 +1,67 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import binascii
+
+
+class IPBitmap(object):
+    """
+    Allocation bitmap of the subnet, bit N is set if address with offset N
+    from the network address is in use. Stored in DB as hex string.
+    """
+
+    def __init__(self, size, data=None):
+        """
+        :param size: number of addresses in the subnet
+        :type size: int
+        :param data: value returned by dumps
+        :type data: str
+        """
+        self.size = size
+        if data:
+            self._bits = bytearray(binascii.unhexlify(data))
+        else:
+            self._bits = bytearray((size + 7) // 8)
+
+    def __contains__(self, offset):
+        return bool(self._bits[offset >> 3] & (1 << (offset & 7)))
+
+    def set(self, offset):
+        self._bits[offset >> 3] |= 1 << (offset & 7)
+
+    def clear(self, offset):
+        self._bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+    def find_free(self, start, stop):
+        """ Return the lowest free offset within [start, stop) or None
+        :type start: int
+        :type stop: int
+        :rtype: int
+        """
+        offset = start
+        while offset < stop:
+            byte = self._bits[offset >> 3]
+            if byte == 0xFF:
+                # Whole byte is in use, jump to the next one
+                offset = (offset | 7) + 1
+                continue
+            if not byte & (1 << (offset & 7)):
+                return offset
+            offset += 1
+        return None
+
+    def dumps(self):
+        """ :rtype: str """
+        return binascii.hexlify(self._bits)
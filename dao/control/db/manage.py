@@ -21,6 +21,7 @@ import migrate.exceptions
 from migrate.versioning import api as versioning_api
 from migrate.versioning import repository
 
+from dao.control.db import archive
 from dao.control.db import session_api
 from dao.control.db import migrate_repo
 
@@ -29,9 +30,13 @@ CONF = session_api.CONF
 ACTIONS = dict()
 
 
-def action(name):
+def action(name, arguments=None):
+    """
+    :param arguments: (args, kwargs) of parser.add_argument for every
+    argument of the action. Action function gets parsed args if set.
+    """
     def _foo(f):
-        ACTIONS[name] = f.__name__
+        ACTIONS[name] = (f.__name__, arguments)
         return f
     return _foo
 
@@ -42,11 +47,20 @@ class Controller(object):
 
     @staticmethod
     def fill_parser(parser):
-        parser.add_argument('action', choices=ACTIONS.keys())
+        subparsers = parser.add_subparsers(dest='action')
+        for name, (_, arguments) in sorted(ACTIONS.items()):
+            subparser = subparsers.add_parser(name)
+            for args, kwargs in arguments or []:
+                subparser.add_argument(*args, **kwargs)
 
     @classmethod
     def feed(cls, args):
-        print getattr(cls, ACTIONS[args.action])()
+        func_name, arguments = ACTIONS[args.action]
+        func = getattr(cls, func_name)
+        if arguments is not None:
+            print func(args)
+        else:
+            print func()
 
     @staticmethod
     def _get_repo_path():
@@ -75,3 +89,16 @@ class Controller(object):
     def _db_version(cls):
         return versioning_api.db_version(
             CONF.db.sql_connection, cls._get_repo_path())
+
+    @classmethod
+    @action('archive', [
+        (['--days'], dict(type=int, default=None,
+                          help='archive rows deleted more than DAYS ago '
+                               '(db.archive_days by default)')),
+        (['--batch-size'], dict(type=int, default=None,
+                                help='number of rows moved in one '
+                                     'transaction'))])
+    def _db_archive(cls, args):
+        result = archive.archive_deleted_rows(args.days, args.batch_size)
+        return '\n'.join('{0}: {1} rows archived'.format(table, count)
+                         for table, count in sorted(result.items()))
@@ -0,0 +1,70 @@
+from migrate import ForeignKeyConstraint
+from sqlalchemy import Column, Table, MetaData, Index
+import logging
+
+from sqlalchemy.dialects.mysql.base import DATETIME
+from sqlalchemy.dialects.mysql.base import INTEGER
+from sqlalchemy.dialects.mysql.base import VARCHAR
+from sqlalchemy.dialects.mysql.base import ENUM
+
+LOG = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    server = Table('server', meta, autoload=True)
+    worker = Table('worker', meta, autoload=True)
+    task = Table(
+        'task', meta,
+        Column('created_at', DATETIME),
+        Column('updated_at', DATETIME),
+        Column('deleted_at', DATETIME),
+        Column('deleted', INTEGER(display_width=11)),
+        Column('key', VARCHAR(length=128)),
+        Column('id', INTEGER(display_width=11),
+               primary_key=True, nullable=False),
+        Column('action', VARCHAR(length=32), nullable=False),
+        Column('lock_id', VARCHAR(length=36), nullable=False),
+        Column('state', ENUM(u'Pending', u'Running', u'Done', u'Failed'),
+               nullable=False),
+        Column('attempts', INTEGER(display_width=11), nullable=False),
+        Column('owner', VARCHAR(length=255)),
+        Column('lease_expires', DATETIME),
+        Column('message', VARCHAR(length=255)),
+        Column('server_id', INTEGER(display_width=11), nullable=False),
+        Column('worker_id', INTEGER(display_width=11)),
+    )
+
+    try:
+        task.create()
+    except Exception:
+        LOG.info(repr(task))
+        LOG.exception('Exception while creating table.')
+        raise
+
+    indexes = [
+        Index('task_worker_id_state_idx', task.c.worker_id, task.c.state),
+        Index('task_server_id_lock_id_idx', task.c.server_id, task.c.lock_id)
+    ]
+
+    for index in indexes:
+        index.create(migrate_engine)
+
+    f_keys = [
+        [[task.c.server_id], [server.c.id]],
+        [[task.c.worker_id], [worker.c.id]],
+    ]
+
+    for f_key_pair in f_keys:
+        if migrate_engine.name in ('mysql', 'postgresql'):
+            fkey = ForeignKeyConstraint(columns=f_key_pair[0],
+                                        refcolumns=f_key_pair[1])
+            fkey.create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    table = Table('task', meta, autoload=True)
+    table.drop()
@@ -0,0 +1,58 @@
+from migrate import ForeignKeyConstraint
+from sqlalchemy import Column, Table, MetaData, Index
+import logging
+
+from sqlalchemy.dialects.mysql.base import DATETIME
+from sqlalchemy.dialects.mysql.base import INTEGER
+from sqlalchemy.dialects.mysql.base import VARCHAR
+
+LOG = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    server = Table('server', meta, autoload=True)
+    server_lock = Table(
+        'server_lock', meta,
+        Column('created_at', DATETIME),
+        Column('updated_at', DATETIME),
+        Column('deleted_at', DATETIME),
+        Column('deleted', INTEGER(display_width=11)),
+        Column('key', VARCHAR(length=128)),
+        Column('id', INTEGER(display_width=11),
+               primary_key=True, nullable=False),
+        Column('server_id', INTEGER(display_width=11), nullable=False),
+        Column('owner', VARCHAR(length=255), nullable=False),
+        Column('expires', DATETIME, nullable=False),
+        Column('heartbeat_at', DATETIME),
+    )
+
+    try:
+        server_lock.create()
+    except Exception:
+        LOG.info(repr(server_lock))
+        LOG.exception('Exception while creating table.')
+        raise
+
+    indexes = [
+        # Unique index is the lock itself
+        Index('server_lock_server_id_idx', server_lock.c.server_id,
+              unique=True),
+        Index('server_lock_owner_idx', server_lock.c.owner)
+    ]
+
+    for index in indexes:
+        index.create(migrate_engine)
+
+    if migrate_engine.name in ('mysql', 'postgresql'):
+        fkey = ForeignKeyConstraint(columns=[server_lock.c.server_id],
+                                    refcolumns=[server.c.id])
+        fkey.create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    table = Table('server_lock', meta, autoload=True)
+    table.drop()
@@ -0,0 +1,16 @@
+from sqlalchemy import Index, MetaData, Table
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    server = Table('server', meta, autoload=True)
+    Index('server_lock_id_idx', server.c.lock_id).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    server = Table('server', meta, autoload=True)
+    Index('server_lock_id_idx', server.c.lock_id).drop(migrate_engine)
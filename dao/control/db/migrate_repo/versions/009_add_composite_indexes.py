@@ -0,0 +1,56 @@
+from sqlalchemy import Index, MetaData, Table
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# table: [(index name, [columns])]
+# Soft deleted rows are filtered out by every query, so deleted column
+# completes every index. server(lock_id, deleted) is indexed by 013.
+INDEXES = {
+    'server': [
+        ('server_asset_id_status_idx', ['asset_id', 'status', 'deleted']),
+    ],
+    'asset': [
+        ('asset_rack_id_type_status_idx',
+         ['rack_id', 'type', 'status', 'deleted']),
+    ],
+    'switch_interface': [
+        ('switch_interface_net_ip_idx', ['net_ip', 'deleted']),
+    ],
+    'subnet': [
+        ('subnet_location_ip_vlan_tag_idx',
+         ['location', 'ip', 'vlan_tag', 'deleted']),
+    ],
+    'port': [
+        ('port_device_id_idx', ['device_id', 'deleted']),
+        ('port_ip_idx', ['ip', 'deleted']),
+    ],
+    'pxe_boot': [
+        ('pxe_boot_serial_lock_id_idx', ['serial', 'lock_id', 'deleted']),
+    ],
+    'worker': [
+        ('worker_name_location_idx', ['name', 'location', 'deleted']),
+    ],
+    'rack': [
+        ('rack_name_location_idx', ['name', 'location', 'deleted']),
+    ],
+}
+
+
+def _indexes(meta):
+    for table_name, indexes in sorted(INDEXES.items()):
+        table = Table(table_name, meta, autoload=True)
+        for name, columns in indexes:
+            yield Index(name, *[table.c[column] for column in columns])
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    for index in _indexes(meta):
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    for index in _indexes(meta):
+        index.drop(migrate_engine)
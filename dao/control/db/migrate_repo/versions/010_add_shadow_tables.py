@@ -0,0 +1,34 @@
+from sqlalchemy import Column, Index, MetaData, Table
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# Tables archived by dao.control.db.archive
+TABLES = ['port', 'server_interface', 'switch_interface', 'pxe_boot',
+          'change_log', 'task']
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    for name in TABLES:
+        table = Table(name, meta, autoload=True)
+        # Same columns, no foreign keys: referenced rows may be purged
+        columns = [Column(c.name, c.type, primary_key=c.primary_key,
+                          nullable=c.nullable)
+                   for c in table.columns]
+        shadow = Table('shadow_' + name, meta, *columns,
+                       mysql_engine='InnoDB')
+        try:
+            shadow.create()
+        except Exception:
+            LOG.info(repr(shadow))
+            LOG.exception('Exception while creating table.')
+            raise
+        Index('shadow_{0}_deleted_at_idx'.format(name),
+              shadow.c.deleted_at).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    for name in TABLES:
+        Table('shadow_' + name, meta, autoload=True).drop()
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Table, MetaData
+import logging
+
+from sqlalchemy import Integer, Text
+
+LOG = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    subnet_table = Table('subnet', meta, autoload=True)
+
+    # Bitmap is built from existing ports on first allocation
+    subnet_table.create_column(Column('ip_bitmap', Text))
+    subnet_table.create_column(Column('ip_hint', Integer, default=0))
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    subnet_table = Table('subnet', meta, autoload=True)
+    subnet_table.c.ip_hint.drop()
+    subnet_table.c.ip_bitmap.drop()
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Index, MetaData, Table
+import logging
+
+from sqlalchemy import VARCHAR
+
+LOG = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    server = Table('server', meta, autoload=True)
+    # Unlike lock_id it is kept when processing is finished
+    server.create_column(Column('request_id', VARCHAR(length=36)))
+    Index('server_request_id_idx',
+          server.c.request_id).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    server = Table('server', meta, autoload=True)
+    Index('server_request_id_idx', server.c.request_id).drop(migrate_engine)
+    server.c.request_id.drop()
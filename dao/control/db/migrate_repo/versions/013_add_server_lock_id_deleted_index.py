@@ -0,0 +1,21 @@
+from sqlalchemy import Index, MetaData, Table
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    server = Table('server', meta, autoload=True)
+    # Composite index serves lock_id lookups as well, so 008 one is dropped
+    Index('server_lock_id_deleted_idx',
+          server.c.lock_id, server.c.deleted).create(migrate_engine)
+    Index('server_lock_id_idx', server.c.lock_id).drop(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    server = Table('server', meta, autoload=True)
+    Index('server_lock_id_idx', server.c.lock_id).create(migrate_engine)
+    Index('server_lock_id_deleted_idx',
+          server.c.lock_id, server.c.deleted).drop(migrate_engine)
@@ -19,7 +19,8 @@ import json
 
 from sqlalchemy import inspect
 from sqlalchemy import ForeignKey
-from sqlalchemy import (Column, Integer, Boolean, String, Enum, Text)
+from sqlalchemy import (Column, Integer, Boolean, String, Enum, Text,
+                        DateTime)
 from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm import exc as sa_exc
@@ -205,6 +206,10 @@ class Subnet(Base):
     gateway = Column(String(31), nullable=False)
     tagged = Column(Boolean, default=False)
     first_ip = Column(String(31))
+    # Allocated addresses, see dao.control.db.ip_bitmap
+    ip_bitmap = Column(Text)
+    # All the allocatable addresses below this offset are in use
+    ip_hint = Column(Integer, default=0)
 
     @property
     def subnet(self):
@@ -333,6 +338,8 @@ class Server(Base):
     chassis_serial = Column(String(63))
     # Fields required by framework itself
     lock_id = Column(String(36))
+    # Last request server was processed within, kept after lock_id is reset
+    request_id = Column(String(36))
     hdd_type = Column(String(127))
     os_args = Column(MutableDict.as_mutable(JSONEncodedDict))
     role_alias = Column(String(64))
@@ -448,3 +455,30 @@ class PxEBoot(Base):
     serial = Column(String(32), nullable=False)
     lock_id = Column(String(36), nullable=False)
     ready = Column(Boolean, default=False)
+
+
+class Task(Base):
+    """Class describes operation dispatched to worker for a server"""
+    __tablename__ = 'task'
+    _states = ['Pending', 'Running', 'Done', 'Failed']
+    id = Column(Integer, primary_key=True)
+    action = Column(String(32), nullable=False)
+    lock_id = Column(String(36), nullable=False)
+    state = Column(Enum(*_states), default='Pending', nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    owner = Column(String(255))
+    lease_expires = Column(DateTime)
+    message = Column(String(255))
+
+    server_id = Column(Integer, ForeignKey('server.id'), nullable=False)
+    worker_id = Column(Integer, ForeignKey('worker.id'), nullable=True)
+
+
+class ServerLock(Base):
+    """Class describes lock of the server held by worker process"""
+    __tablename__ = 'server_lock'
+    id = Column(Integer, primary_key=True)
+    server_id = Column(Integer, ForeignKey('server.id'), nullable=False)
+    owner = Column(String(255), nullable=False)
+    expires = Column(DateTime, nullable=False)
+    heartbeat_at = Column(DateTime)
@@ -16,6 +16,7 @@
 # under the License.
 
 import eventlet
+import eventlet.corolocal
 import os
 import time
 import sqlalchemy.orm
@@ -68,6 +69,9 @@ sql_opts = [
     cfg.BoolOpt('db', 'sql_connection_trace',
                 default=False,
                 help='Add python stack traces to SQL as comment strings'),
+    cfg.IntOpt('db', 'yield_per',
+               default=1000,
+               help='Number of rows fetched at once by streaming requests'),
 ]
 
 cfg.register(sql_opts)
@@ -75,6 +79,8 @@ CONF = cfg.get_config()
 LOG = log.getLogger(__name__)
 _ENGINE = None
 _MAKER = None
+# Green thread local, works for native threads as well
+_LOCAL = eventlet.corolocal.local()
 
 
 def greenthread_yield(dbapi_con, con_record):
@@ -220,6 +226,16 @@ def get_engine():
     return _ENGINE
 
 
+def dispose_engine():
+    """Close connections of the engine and forget it. Must be called before
+    fork, so every process creates own connection pool."""
+    global _ENGINE, _MAKER
+    if _ENGINE is not None:
+        _ENGINE.dispose()
+    _ENGINE = None
+    _MAKER = None
+
+
 def get_maker(engine, autocommit=True, expire_on_commit=False):
     """Return a SQLAlchemy sessionmaker using the given engine."""
     return sqlalchemy.orm.sessionmaker(bind=engine,
@@ -229,13 +245,113 @@ def get_maker(engine, autocommit=True, expire_on_commit=False):
                                        query_cls=sqlalchemy.orm.query.Query)
 
 
-def get_session(autocommit=True, expire_on_commit=False):
-    """Return a SQLAlchemy session."""
+def get_session(autocommit=True, expire_on_commit=False, scoped=True):
+    """Return a SQLAlchemy session.
+    Session of the current unit of work is returned if there is one and
+    scoped is True."""
     global _MAKER
 
+    if scoped and current_session() is not None:
+        return current_session()
+
     if _MAKER is None:
         engine = get_engine()
         _MAKER = get_maker(engine, autocommit, expire_on_commit)
 
     session = _MAKER()
     return session
+
+
+def current_session():
+    """Return session of the unit of work of the current thread or None"""
+    return getattr(_LOCAL, 'session', None)
+
+
+def on_commit(func, *args, **kwargs):
+    """Call function once the unit of work is committed, e.g. to send RPC
+    about data written within the unit. Called right away if there is no
+    unit of work."""
+    if current_session() is None:
+        return func(*args, **kwargs)
+    _LOCAL.on_commit.append((func, args, kwargs))
+
+
+class unit_of_work(object):
+    """
+    Context manager for a request scoped session. All DB calls of the
+    thread (green thread if eventlet is monkey patched) within the context
+    share one session and one transaction.
+    Transaction is committed on exit and rolled back if exception is
+    raised, so partial changes of a failed request are not kept. Writes
+    which must survive the failure, e.g. error saved on a server, are to
+    be done outside of the unit. Nested units join the outer one.
+    """
+
+    def __init__(self):
+        self.session = None
+
+    def __enter__(self):
+        if current_session() is not None:
+            return current_session()
+        self.session = get_session(scoped=False)
+        self.session.begin()
+        _LOCAL.session = self.session
+        _LOCAL.on_commit = []
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.session is None:
+            # Nested unit
+            return
+        callbacks, _LOCAL.on_commit = _LOCAL.on_commit, []
+        _LOCAL.session = None
+        if exc_type is not None:
+            try:
+                self.session.rollback()
+            finally:
+                self.session.close()
+            return
+        try:
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.close()
+        for func, args, kwargs in callbacks:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                LOG.exception('Commit callback %s failed', func)
+
+
+class savepoint(object):
+    """
+    Nested transaction within the unit of work. Changes and commit
+    callbacks registered within the savepoint are discarded if exception
+    is raised.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.mark = 0
+
+    def __enter__(self):
+        self.session = current_session()
+        if self.session is None:
+            raise RuntimeError('savepoint is used outside of unit of work')
+        self.mark = len(_LOCAL.on_commit)
+        self.session.begin_nested()
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            try:
+                self.session.commit()
+                return
+            except Exception:
+                self.session.rollback()
+                del _LOCAL.on_commit[self.mark:]
+                raise
+        self.session.rollback()
+        del _LOCAL.on_commit[self.mark:]
@@ -12,7 +12,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import itertools
+import json
 import netaddr
+import threading
 import traceback
 import uuid
 
@@ -24,8 +27,19 @@ from dao.control import exceptions
 from dao.control import server_processor
 from dao.control import worker_api
 from dao.control.db import api as db_api
+from dao.control.db import archive
+from dao.control.db import session_api
+from dao.control.master import wsgi
 
 
+opts = [
+    config.IntOpt('master', 'trigger_chunk',
+                  default=50,
+                  help='Maximum number of servers of a rack locked and '
+                       'dispatched within one transaction by rack_trigger.'),
+]
+
+config.register(opts)
 CONF = config.get_config()
 LOG = log.getLogger(__name__)
 app = flask.Flask(__name__)
@@ -37,13 +51,29 @@ class Context(object):
         self.location = location
 
 
+def remote_call(func):
+    """ Mark Manager method doing synchronous calls to worker. Such method
+    is run without unit of work: transaction is not held across the call
+    and the worker sees changes made before it.
+    """
+    func.remote_call = True
+    return func
+
+
 class Manager(object):
     def __init__(self):
         self.db = db_api.Driver()
 
-    def objects_list(self, context, cls, joins, loads, **kwargs):
-        return [obj.to_dict() for obj in
-                self.db.objects_get_by(cls, joins, loads, **kwargs)]
+    def objects_list(self, context, cls, joins, loads, limit=None,
+                     after_id=None, **kwargs):
+        return list(self.objects_iter(context, cls, joins, loads,
+                                      limit, after_id, **kwargs))
+
+    def objects_iter(self, context, cls, joins, loads, limit=None,
+                     after_id=None, **kwargs):
+        return (obj.to_dict() for obj in
+                self.db.objects_iter_by(cls, joins, loads, limit=limit,
+                                        after_id=after_id, **kwargs))
 
     def object_update(self, context, object_type, key, key_value, args_dict):
         obj = self.db.object_get(object_type, key, key_value)
@@ -53,6 +83,7 @@ class Manager(object):
 
     def register_server(self, context, serial, lock_id):
         """ Register server. Function is to be called from on server boot.
+        Worker is notified to check the server right away.
         :type ip: str
         :type asset: dict([brand, model, serial, ip, mac])
         :type interfaces: dict
@@ -64,8 +95,27 @@ class Manager(object):
         except exceptions.DAONotFound, exc:
             # Send True to keep it calm
             LOG.debug(exc)
+        try:
+            server = self.db.server_get_by(**{'asset.serial': serial,
+                                              'lock_id': lock_id})
+        except Exception, exc:
+            # Worker will check server periodically anyway
+            LOG.debug(exc)
+        else:
+            # Worker must see pxe_boot update
+            session_api.on_commit(self._check_server, server.rack_name,
+                                  server.id, lock_id)
         return True
 
+    @staticmethod
+    def _check_server(rack_name, sid, lock_id):
+        try:
+            worker = worker_api.WorkerAPI.get_api(rack_name=rack_name)
+            worker.send('check_server', sid, lock_id)
+        except Exception, exc:
+            # Worker will check server periodically anyway
+            LOG.debug(exc)
+
     def asset_protect(self, context, serial, rack_name, set_protected):
         rack = self.db.rack_get(name=rack_name)
         if rack.location != context.location:
@@ -94,25 +144,30 @@ class Manager(object):
         workers = self.db.worker_list(location=context.location)
         return [w.to_dict() for w in workers]
 
-    def history(self, context, obj_type, key, value):
+    def history(self, context, obj_type, key, value, limit=None,
+                after_id=None):
         """Update rack with meta information"""
         if key and value:
             obj_id = self.db.object_get(obj_type, key, value).id
         else:
             obj_id = None
-        history = [x.to_dict() for x in self.db.change_log(obj_type, obj_id)]
+        history = [x.to_dict() for x in
+                   self.db.change_log(obj_type, obj_id, limit, after_id)]
         return history
 
+    @remote_call
     def rack_discover(self, context, worker_name, switch_name, ip, create):
         worker = self._worker_get(context, worker_name=worker_name)
         worker = worker_api.WorkerAPI.get_api(worker=worker)
         return worker.call('rack_discover', switch_name, ip, create)
 
+    @remote_call
     def rack_renumber(self, context, rack_name, fake):
         worker = self._worker_get(context, rack_name=rack_name)
         worker = worker_api.WorkerAPI.get_api(worker=worker)
         return worker.call('rack_renumber', rack_name, fake)
 
+    @remote_call
     def dhcp_rack_update(self, context, rack_name):
         worker = self._worker_get(context, rack_name=rack_name)
         worker = worker_api.WorkerAPI.get_api(worker=worker)
@@ -126,6 +181,7 @@ class Manager(object):
     def network_map_list(self, context, **kwargs):
         return [i.to_dict() for i in self.db.network_map_list(**kwargs)]
 
+    @remote_call
     def discovery_cache_reset(self, context, worker_name, mac):
         worker = self._worker_get(context, worker_name=worker_name)
         worker = worker_api.WorkerAPI.get_api(worker=worker)
@@ -137,6 +193,7 @@ class Manager(object):
             name, port2number, number2unit, pxe_nic, network)
         return net_map.to_dict()
 
+    @remote_call
     def rack_update(self, context, rack_name, env, gw, net_map, worker_name,
                     reset_worker, meta):
         """Update rack with meta information"""
@@ -176,6 +233,7 @@ class Manager(object):
             api.call('dhcp_rack_update', rack_name)
         return self.db.rack_get(name=rack_name).to_dict()
 
+    @remote_call
     def health_check(self, context, worker):
         worker = self._worker_get(context, worker_name=worker)
         worker = worker_api.WorkerAPI.get_api(worker=worker)
@@ -184,12 +242,14 @@ class Manager(object):
     def rack_trigger(self, context, rack_name, cluster_name, role, hdd_type,
                      serial, names, from_status, set_status, target_status,
                      os_args):
-
+        """ Select servers and start processing them in background.
+        Progress can be requested with self.request_status.
+        :rtype: list of str
+        """
         rack = self.db.rack_get(name=rack_name)
         if rack.meta.get('maintenance', False):
             raise exceptions.DAOConflict('Rack is under maintenance')
         request_id = uuid.uuid4().get_hex()
-        response = ['Request_id={0}'.format(request_id)]
         LOG.info('Request id: {0}'.format(request_id))
         filters = {'asset.rack.location': context.location}
         if rack_name:
@@ -201,72 +261,158 @@ class Manager(object):
         if from_status:
             filters['status'] = from_status
         servers = self.db.servers_get_by(**filters)
+        cluster = None
         if cluster_name:
             cluster = self.db.cluster_get(cluster_name)
 
         if not servers:
             raise exceptions.DAONotFound(
                 'No servers were found. Please check filter conditions')
+        thread = threading.Thread(
+            target=self._rack_trigger,
+            args=(context, request_id, servers, cluster_name, cluster, role,
+                  hdd_type, set_status, target_status, os_args))
+        thread.daemon = True
+        # Servers must be detached from the request session first
+        session_api.on_commit(thread.start)
+        return ['Request_id={0}'.format(request_id),
+                '{0} servers accepted'.format(len(servers))]
+
+    def _rack_trigger(self, context, request_id, servers, cluster_name,
+                      cluster, role, hdd_type, set_status, target_status,
+                      os_args):
+        """ Background part of self.rack_trigger.
+        Servers are processed by chunks of the same rack. Servers of a chunk
+        are locked in bulk and their tasks are created within the same
+        transaction, so locked servers are never left without a task if the
+        process dies. Row locks are released as every chunk is committed,
+        workers are notified after that.
+        """
+        def log_action(_server, _action):
+            LOG.info('Request {0}: server {1.id}:{1.name} {2}'.
+                     format(request_id, _server, _action))
+
+        prepared = []
         for server in servers:
-            old_status = server.status
-            if server.lock_id:
-                response.append('Server {0.id}:{0.name} is busy '
-                                'with request {0.lock_id}'.format(server))
-                continue
-            if server.asset.protected:
-                response.append('Server {0.id}:{0.name} is protected one'.
-                                format(server))
-                continue
-            if server.meta.get('ironicated', False):
-                response.append('Server {0.key}:{0.name} '
-                                'is under Ironic control'.format(server))
-                continue
-            action = None
-            if os_args:
-                server.os_args = os_args
-            if set_status is not None:
-                server.status = set_status
-            if role is not None:
-                server.role = role
-            if cluster_name:
-                server.cluster_set(cluster)
-            if target_status is not None:
-                server.target_status = target_status
-            if hdd_type is not None:
-                server.hdd_type = hdd_type
-            # Ensure current and target statuses
-            _index = server_processor.ServerProcessor.statuses.index
-            if _index(server.status) > _index(server.target_status):
-                action = 'target status is less than current status. Ignored.'
-            elif _index(server.target_status) >= _index('Provisioned'):
-                # for some reason if cluster wasn't assigned cluster_id is '0'
-                # because of this validate cluster_name
-                if not cluster_name and not server.cluster_name:
-                    action = 'cluster is not specified. Ignored.'
-                elif not server.role:
-                    action = 'role is not specified. Ignored.'
-            # if everything is ok with parameters continue
-            if not action:
-                message = 'Pre-provision clean-up' \
-                    if old_status != server.status else None
-                server.lock_id = request_id
-                server.initiator = context.user
-                server = self.db.server_update(server, message, log=True)
-                started = server_processor.ServerProcessor(server).next()
-                if started:
-                    action = 'Processing started' if started else 'ignored'
-                else:
-                    action = 'Fields update only, status={0}, ' \
-                             'target_status={1}'.\
-                        format(server.status, server.target_status)
-            response.append('Server {0.id}:{0.name} {1}'.format(server,
-                                                                action))
-        return response
+            try:
+                action = self._server_trigger(
+                    context, request_id, server, cluster_name, cluster,
+                    role, hdd_type, set_status, target_status, os_args)
+            except Exception, exc:
+                LOG.warning(traceback.format_exc())
+                action = 'failed: {0}'.format(exc.message or repr(exc))
+            if action is None:
+                prepared.append(server)
+            else:
+                log_action(server, action)
+        prepared.sort(key=lambda s: s.rack_name)
+        size = CONF.master.trigger_chunk
+        for _, rack_servers in itertools.groupby(prepared,
+                                                 lambda s: s.rack_name):
+            rack_servers = list(rack_servers)
+            for i in range(0, len(rack_servers), size):
+                chunk = rack_servers[i:i + size]
+                try:
+                    actions = self._rack_trigger_chunk(chunk)
+                except Exception, exc:
+                    LOG.warning(traceback.format_exc())
+                    action = 'failed: {0}'.format(exc.message or repr(exc))
+                    actions = [(server, action) for server in chunk]
+                for server, action in actions:
+                    log_action(server, action)
+
+    def _rack_trigger_chunk(self, servers):
+        """ Lock servers and dispatch them within one transaction.
+        :type servers: list of dao.control.db.model.Server
+        :return: action description for every server
+        :rtype: list of tuple
+        """
+        actions = []
+        with session_api.unit_of_work():
+            updated, conflicts = self.db.servers_update_bulk(servers,
+                                                             log=True)
+            for server in conflicts:
+                actions.append((server, 'was changed concurrently. Ignored.'))
+            for server in updated:
+                try:
+                    with session_api.savepoint():
+                        processor = server_processor.ServerProcessor(server)
+                        started = processor.next()
+                    if started:
+                        action = 'Processing started'
+                    else:
+                        action = 'Fields update only, status={0}, ' \
+                                 'target_status={1}'.\
+                            format(server.status, server.target_status)
+                except Exception, exc:
+                    LOG.warning(traceback.format_exc())
+                    action = 'failed: {0}'.format(exc.message or repr(exc))
+                    # Do not keep the server locked without a task
+                    server.lock_id = ''
+                    self.db.server_update(server)
+                actions.append((server, action))
+        return actions
+
+    def _server_trigger(self, context, request_id, server, cluster_name,
+                        cluster, role, hdd_type, set_status, target_status,
+                        os_args):
+        """ Update server fields, server is not saved.
+        :rtype: str
+        :return: description of the reason server is ignored, None if
+        server is ready to be processed
+        """
+        old_status = server.status
+        if server.lock_id:
+            return 'is busy with request {0.lock_id}'.format(server)
+        if server.asset.protected:
+            return 'is protected one'
+        if server.meta.get('ironicated', False):
+            return 'is under Ironic control'
+        if os_args:
+            server.os_args = os_args
+        if set_status is not None:
+            server.status = set_status
+        if role is not None:
+            server.role = role
+        if cluster_name:
+            server.cluster_set(cluster)
+        if target_status is not None:
+            server.target_status = target_status
+        if hdd_type is not None:
+            server.hdd_type = hdd_type
+        # Ensure current and target statuses
+        _index = server_processor.ServerProcessor.statuses.index
+        if _index(server.status) > _index(server.target_status):
+            return 'target status is less than current status. Ignored.'
+        elif _index(server.target_status) >= _index('Provisioned'):
+            # for some reason if cluster wasn't assigned cluster_id is '0'
+            # because of this validate cluster_name
+            if not cluster_name and not server.cluster_name:
+                return 'cluster is not specified. Ignored.'
+            elif not server.role:
+                return 'role is not specified. Ignored.'
+        # if everything is ok with parameters continue
+        if old_status != server.status:
+            server.message = 'Pre-provision clean-up'
+        server.lock_id = request_id
+        server.request_id = request_id
+        server.initiator = context.user
+        return None
+
+    def request_status(self, context, request_id):
+        """ Return number of servers per status for servers processed
+        within the request.
+        :type request_id: str
+        :rtype: dict
+        """
+        return self.db.servers_count_by_status(request_id,
+                                               context.location)
 
     @staticmethod
     def get_env(context):
         return dict(db_url=CONF.common.db_url)
 
+    @remote_call
     def server_delete(self, context, sid, serial, name):
         server = self.db.server_get_by(
             **{'id': int(sid), 'asset.serial': serial, 'name': name})
@@ -276,6 +422,7 @@ class Manager(object):
         worker = worker_api.WorkerAPI.get_api(worker=worker)
         return worker.call('server_delete', server.id)
 
+    @remote_call
     def server_stop(self, context, request_id, names, rack_name, force):
         filters = dict()
         filters['asset.rack.location'] = context.location
@@ -307,9 +454,18 @@ class Manager(object):
         return response
 
     def servers_list(self, context, rack_name, cluster_name, serials, ips,
-                     macs, names, from_status, sku_name, detailed):
-        # get servers
-        skus = self.db.sku_get_all() if detailed or sku_name else None
+                     macs, names, from_status, sku_name, detailed,
+                     limit=None, after_id=None):
+        return dict((s_dict['name'], s_dict) for s_dict in self.servers_iter(
+            context, rack_name, cluster_name, serials, ips, macs, names,
+            from_status, sku_name, detailed, limit, after_id))
+
+    def servers_iter(self, context, rack_name, cluster_name, serials, ips,
+                     macs, names, from_status, sku_name, detailed,
+                     limit=None, after_id=None):
+        """ Streaming version of self.servers_list
+        :rtype: generator of dict
+        """
         filters = dict()
         filters['asset.rack.location'] = context.location
         if serials:
@@ -327,55 +483,44 @@ class Manager(object):
 
         if sku_name:
             try:
-                filters['sku_id'] = [sku.id for sku in skus
-                                     if sku.name == sku_name][0]
-            except IndexError:
+                filters['sku_id'] = self.db.sku_get(sku_name).id
+            except exceptions.DAONotFound:
                 raise exceptions.DAONotFound(
                     'SKU <{0}> not found'.format(sku_name))
 
         if names:
             filters['name'] = names
-        servers = self.db.servers_get_by(**filters)
-        # format servers output
-        return self._servers2dict(servers, skus, detailed)
-
-    @staticmethod
-    def _servers2dict(servers, skus, detailed):
-        def get_field(_field, _s_dict):
-            _fields = _field.split('.')
-            _it = _s_dict
-            for _f in _fields:
-                _it = _it.get(_f)
-            return _it
         # format servers output
         fields = ['name', 'status', 'asset.rack.name', 'asset.asset_tag',
                   'asset.serial', 'lock_id', 'role', 'message']
         if detailed:
-            sku2name = dict((sku.id, sku.name) for sku in skus)
             fields.extend(['id', 'hdd_type', 'meta', 'os_args', 'gw_ip',
                            'fqdn', 'target_status', 'cluster.name',
                            'interfaces', 'description', 'asset.protected',
                            'server_number', 'pxe_mac', 'pxe_ip', 'asset.ip',
                            'asset.mac', 'rack_unit', 'asset.key',
-                           'chassis_serial'])
-        if_fields = ['state', 'mac', 'name']
-        result = dict()
-        for server in servers:
-            s_dict = server.to_dict()
-            s_dict = dict((item, get_field(item, s_dict))
-                          for item in fields)
+                           'chassis_serial', 'updated_at', 'sku.name'])
+        if limit is not None or after_id is not None:
+            # id is required to request the next page
+            if 'id' not in fields:
+                fields.append('id')
+            filters.update(limit=limit, after_id=after_id)
+        for s_dict in self.db.servers_fields_iter_by(fields, **filters):
             if detailed:
-                s_dict['updated'] = str(server.updated_at)
-                s_dict['sku'] = sku2name.get(server.sku_id)
-                interfaces = [dict((k, if_[k]) for k in if_fields)
-                              for if_ in s_dict['interfaces'].values()]
-                s_dict['interfaces'] = interfaces
-
-            result[server.name] = s_dict
-        return result
+                s_dict['updated'] = str(s_dict.pop('updated_at'))
+                s_dict['sku'] = s_dict.pop('sku.name')
+            yield s_dict
 
     def assets_list(self, context, rack_name, protected, names,
-                    serials, type_):
+                    serials, type_, limit=None, after_id=None):
+        return list(self.assets_iter(context, rack_name, protected, names,
+                                     serials, type_, limit, after_id))
+
+    def assets_iter(self, context, rack_name, protected, names,
+                    serials, type_, limit=None, after_id=None):
+        """ Streaming version of self.assets_list
+        :rtype: generator of dict
+        """
         def to_dict(_asset):
             d = _asset.to_dict(deep=False)
             d['rack_name'] = _asset.rack.name
@@ -394,16 +539,17 @@ class Manager(object):
         if type_:
             filters['type'] = type_
 
-        assets = self.db.assets_get_by(**filters)
         # fields = ['name', 'asset_tag', 'ip', 'mac', 'location', 'serial',
         #           'status', 'type', 'protected', 'model', 'brand']
-        result = [to_dict(asset) for asset in assets]
-        return result
+        return (to_dict(asset) for asset in
+                self.db.assets_iter_by(limit=limit, after_id=after_id,
+                                       **filters))
 
     def rack_list(self, context, detailed, **kwargs):
+        kwargs['location'] = context.location
         racks = self.db.rack_get_all(**kwargs)
-        # TODO: Workaround. Apply filter on query step
-        racks = [r for r in racks if r.location == context.location]
+        if detailed:
+            subnets = self.db.subnets_get_by_racks([r.name for r in racks])
         result = {}
         for rack in racks:
             temp = dict(
@@ -414,7 +560,7 @@ class Manager(object):
             )
             if detailed:
                 temp['networks'] = [net.to_dict() for net in
-                                    self.db.subnets_get(rack.name)]
+                                    subnets[rack.name]]
                 temp['gw_ip'] = rack.gw_ip
                 if rack.network_map is not None:
                     temp['pxe_nic'] = rack.network_map.pxe_nic
@@ -434,6 +580,14 @@ class Manager(object):
         # TODO: Workaround. Apply filter on query step
         clusters = [c for c in clusters if c.location == context.location]
         result = {}
+        if detailed:
+            servers = self.db.servers_brief_get_by_clusters(
+                [c.id for c in clusters])
+            cluster2servers = dict(
+                (cid, [dict(name=name, serial=serial, status=status)
+                       for _, name, serial, status in items])
+                for cid, items in itertools.groupby(servers,
+                                                    lambda s: s[0]))
         for cluster in clusters:
             c_dict = dict(
                 id=cluster.id,
@@ -441,11 +595,7 @@ class Manager(object):
                 type=cluster.type
             )
             if detailed:
-                cs = [dict(name=s.name,
-                           serial=s.asset.serial,
-                           status=s.status)
-                      for s in self.db.servers_get_by_cluster(cluster)]
-                c_dict['servers'] = cs
+                c_dict['servers'] = cluster2servers.get(cluster.id, [])
             result[cluster.name] = c_dict
         return result
 
@@ -460,11 +610,16 @@ class Manager(object):
     def sku_list(self, context):
         return [i.to_dict() for i in self.db.sku_get_all(context.location)]
 
+    @remote_call
     def os_list(self, context, worker_name, os_name):
         worker = self._worker_get(context, worker_name=worker_name)
         worker = worker_api.WorkerAPI.get_api(worker=worker)
         return worker.call('os_list', os_name)
 
+    def query_cache_stats(self, context):
+        """ Return hit rate of DB query cache of the master process """
+        return self.db.query_cache_stats()
+
     def _worker_get(self, context, worker_name=None, rack_name=None):
         """
         :type context: dao.control.master.manager.Context
@@ -481,6 +636,12 @@ class Manager(object):
         return self.db.worker_get(**filters)
 
 
+# Functions which results can be streamed mapped to generator functions
+STREAMS = {'servers_list': 'servers_iter',
+           'assets_list': 'assets_iter',
+           'objects_list': 'objects_iter'}
+
+
 @app.route('/v1.0/tasks', methods=['POST'])
 def task():
     m = Manager()
@@ -496,17 +657,127 @@ def task():
     user, environment, args = args[0], args[1], args[2:]
     context = Context(user, environment)
     args = (context,) + tuple(args)
+    if request.json.get('stream') and func_name in STREAMS:
+        return _task_stream(m, STREAMS[func_name], args, kwargs)
     try:
-        result = getattr(m, func_name)(*args, **kwargs)
+        func = getattr(m, func_name)
+        if getattr(func, 'remote_call', False):
+            result = func(*args, **kwargs)
+        else:
+            with session_api.unit_of_work():
+                result = func(*args, **kwargs)
     except Exception, exc:
         return exc.message, 418
     return flask.jsonify({'result': result}), 201
 
 
+def _task_stream(m, func_name, args, kwargs):
+    """ Return result as newline delimited json, one object per line.
+    Error raised after the first object is sent as {"error": message}.
+    """
+    try:
+        # Run the request before response is started to report errors
+        items = iter(getattr(m, func_name)(*args, **kwargs))
+        first = [next(items)]
+    except StopIteration:
+        first = []
+    except Exception, exc:
+        return exc.message, 418
+
+    def generate():
+        try:
+            for item in itertools.chain(first, items):
+                yield json.dumps(item) + '\n'
+        except Exception, exc:
+            LOG.warning(traceback.format_exc())
+            yield json.dumps({'error': exc.message or repr(exc)}) + '\n'
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          status=201, mimetype='application/x-ndjson')
+
+
+@app.route('/v1.0/tasks/batch', methods=['POST'])
+def task_batch():
+    """ Run a list of calls under one context. Request json:
+        {'args': [user, environment],
+         'calls': [{'func': name, 'args': [...], 'kwargs': {...}}, ...]}
+    Every call is processed independently, response contains a list of
+    {'result': result} or {'error': message} in the order of the calls.
+    """
+    m = Manager()
+    request = flask.request
+    if (not request.json or
+            'args' not in request.json or
+            'calls' not in request.json):
+        flask.abort(400)
+    if (not isinstance(request.json['args'], list) or
+            len(request.json['args']) < 2):
+        flask.abort(400, 'args must be a list of [user, environment]')
+    if not isinstance(request.json['calls'], list):
+        flask.abort(400, 'calls must be a list')
+    for call in request.json['calls']:
+        if (not isinstance(call, dict) or
+                not isinstance(call.get('func'), basestring) or
+                not isinstance(call.get('args', []), list) or
+                not isinstance(call.get('kwargs', {}), dict)):
+            flask.abort(400, 'Every call must be a dict with func name, '
+                             'args list and kwargs dict')
+    user, environment = request.json['args'][:2]
+    context = Context(user, environment)
+    results = []
+
+    def _run(_call):
+        func = getattr(m, _call.get('func', ''))
+        args = (context,) + tuple(_call.get('args', ()))
+        return func(*args, **_call.get('kwargs', {}))
+
+    def _is_remote(_call):
+        func = getattr(m, _call.get('func', ''), None)
+        return getattr(func, 'remote_call', False)
+
+    # Consecutive local calls share one unit of work, remote calls are run
+    # between units, so they see changes of the calls made before.
+    for remote, calls in itertools.groupby(request.json['calls'],
+                                           _is_remote):
+        if remote:
+            for call in calls:
+                try:
+                    results.append({'result': _run(call)})
+                except Exception, exc:
+                    LOG.debug(traceback.format_exc())
+                    results.append({'error': exc.message or repr(exc)})
+            continue
+        with session_api.unit_of_work():
+            for call in calls:
+                func_name = call.get('func', '')
+                if func_name.startswith('_') or not hasattr(m, func_name):
+                    results.append({'error': 'Unknown function {0}'.
+                                             format(func_name)})
+                    continue
+                try:
+                    # Discard changes of the failed call only
+                    with session_api.savepoint():
+                        result = _run(call)
+                except Exception, exc:
+                    LOG.debug(traceback.format_exc())
+                    results.append({'error': exc.message or repr(exc)})
+                else:
+                    results.append({'result': result})
+    return flask.jsonify({'result': results}), 201
+
+
 def run():
     LOG.info('Started')
     try:
-        app.run(debug=True)
+        if CONF.master.server == 'development':
+            archive.start_periodic()
+            app.run(host=CONF.master.bind_host, port=CONF.master.bind_port,
+                    debug=True)
+        else:
+            # Archiving is run by dedicated process, not in a forked one
+            service = (archive.run_periodic
+                       if CONF.db.archive_interval > 0 else None)
+            wsgi.Server(app, service=service).run()
     except:
         LOG.warning(traceback.format_exc())
         raise
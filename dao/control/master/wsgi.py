@@ -0,0 +1,235 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import errno
+import os
+import signal
+import sys
+import time
+import traceback
+
+import eventlet
+import eventlet.wsgi
+
+from dao.common import config
+from dao.common import log
+from dao.control.db import change_log
+from dao.control.db import session_api
+
+
+opts = [
+    config.StrOpt('master', 'server',
+                  default='eventlet',
+                  help='Server to serve master API: eventlet or development '
+                       '(single threaded Flask server, debug only).'),
+
+    config.StrOpt('master', 'bind_host',
+                  default='127.0.0.1',
+                  help='Address master API listens on.'),
+
+    config.IntOpt('master', 'bind_port',
+                  default=5000,
+                  help='Port master API listens on.'),
+
+    config.IntOpt('master', 'workers',
+                  default=1,
+                  help='Number of master API processes.'),
+
+    config.IntOpt('master', 'pool_size',
+                  default=100,
+                  help='Number of green threads serving requests in every '
+                       'master API process.'),
+
+    config.IntOpt('master', 'request_timeout',
+                  default=300,
+                  help='Time in seconds request processing may take, 0 '
+                       'means no limit.'),
+
+    config.IntOpt('master', 'shutdown_timeout',
+                  default=60,
+                  help='Time in seconds to wait for running requests on '
+                       'graceful restart or stop.'),
+]
+
+config.register(opts)
+CONF = config.get_config()
+LOG = log.getLogger(__name__)
+
+
+class TimeoutMiddleware(object):
+    """ Abort request if it takes longer than master.request_timeout """
+
+    def __init__(self, app, timeout):
+        self.app = app
+        self.timeout = timeout
+
+    def __call__(self, environ, start_response):
+        if not self.timeout:
+            return self.app(environ, start_response)
+        try:
+            # Response body is not covered, so streaming is not limited
+            with eventlet.Timeout(self.timeout):
+                return self.app(environ, start_response)
+        except eventlet.Timeout:
+            LOG.warning('Request %s %s timed out',
+                        environ.get('REQUEST_METHOD'),
+                        environ.get('PATH_INFO'))
+            start_response('504 Gateway Timeout',
+                           [('Content-Type', 'text/plain')],
+                           sys.exc_info())
+            return ['Request timed out']
+
+
+class Server(object):
+    """
+    Pre-forking eventlet WSGI server.
+    Parent process binds the socket and keeps master.workers children
+    running. SIGHUP gracefully restarts the children: new ones are started
+    and old ones stop accepting and finish running requests. SIGTERM
+    stops everything the same graceful way.
+    Optional service function is run forever in one more child process,
+    so background jobs are not duplicated by request serving processes.
+    """
+
+    def __init__(self, app, service=None):
+        self.app = TimeoutMiddleware(app, CONF.master.request_timeout)
+        self.service = service
+        self.service_pid = None
+        self.children = set()
+        self.sock = None
+        self._signo = None
+
+    def run(self):
+        self.sock = eventlet.listen((CONF.master.bind_host,
+                                     CONF.master.bind_port),
+                                    backlog=128)
+        LOG.info('Listening on %s:%s with %s workers',
+                 CONF.master.bind_host, CONF.master.bind_port,
+                 CONF.master.workers)
+        signal.signal(signal.SIGHUP, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        self._start_children(CONF.master.workers)
+        self._start_service()
+        while True:
+            signo, self._signo = self._signo, None
+            if signo == signal.SIGHUP:
+                LOG.info('Graceful restart')
+                old = set(self.children)
+                self.children.clear()
+                self._start_children(CONF.master.workers)
+                self._kill(old, signal.SIGHUP)
+            elif signo is not None:
+                LOG.info('Stopping')
+                if self.service_pid is not None:
+                    self.children.add(self.service_pid)
+                self._kill(self.children, signal.SIGTERM)
+                self._wait_children()
+                return
+            try:
+                pid, status = os.wait()
+            except OSError, exc:
+                if exc.errno not in (errno.EINTR, errno.ECHILD):
+                    raise
+                if exc.errno == errno.ECHILD:
+                    time.sleep(0.1)
+                continue
+            if pid in self.children:
+                self.children.discard(pid)
+                LOG.warning('Master process %s exited with %s, restarting',
+                            pid, status)
+                self._start_children(1)
+            elif pid == self.service_pid:
+                LOG.warning('Service process %s exited with %s, restarting',
+                            pid, status)
+                self._start_service()
+
+    def _on_signal(self, signo, frame):
+        self._signo = signo
+
+    def _start_children(self, number):
+        for _ in range(number):
+            # Every process must have own DB connection pool
+            session_api.dispose_engine()
+            pid = os.fork()
+            if pid == 0:
+                self._run_child()
+                os._exit(0)
+            self.children.add(pid)
+            LOG.info('Master process %s started', pid)
+
+    def _start_service(self):
+        if self.service is None:
+            return
+        session_api.dispose_engine()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                self.service()
+            except Exception:
+                LOG.warning(traceback.format_exc())
+            os._exit(1)
+        self.service_pid = pid
+        LOG.info('Service process %s started', pid)
+
+    @staticmethod
+    def _kill(pids, signo):
+        for pid in pids:
+            try:
+                os.kill(pid, signo)
+            except OSError:
+                pass
+
+    def _wait_children(self):
+        while self.children:
+            try:
+                pid, _ = os.wait()
+            except OSError:
+                break
+            self.children.discard(pid)
+
+    def _run_child(self):
+        stop = []
+
+        def _stop(signo, frame):
+            # Server is stopped by the main green thread, see below
+            stop.append(signo)
+
+        signal.signal(signal.SIGHUP, _stop)
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        eventlet.monkey_patch()
+        pool = eventlet.GreenPool(CONF.master.pool_size)
+        server = eventlet.spawn(eventlet.wsgi.server, self.sock, self.app,
+                                custom_pool=pool)
+        try:
+            while not stop:
+                if server.dead:
+                    server.wait()
+                    raise RuntimeError('WSGI server exited')
+                eventlet.sleep(1)
+            # Stop accepting and let running requests complete
+            server.kill()
+            with eventlet.Timeout(CONF.master.shutdown_timeout, False):
+                pool.waitall()
+            # os._exit skips atexit handlers
+            change_log.stop()
+        except Exception:
+            LOG.warning(traceback.format_exc())
+            change_log.stop()
+            os._exit(1)
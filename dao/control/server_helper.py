@@ -126,10 +126,6 @@ def mac_get(network_map, vlan_tag, server):
 
 
 def generate_network(dhcp, rack, server, nets):
-    def _get_ip(_net):
-        return dhcp.allocate(rack, _net, server.asset.serial,
-                             mac_get(network, _net.vlan_tag, server))
-
     def net_item(vlan):
         return (_vlan2net[vlan], dict(ip=vlan2ip[vlan][0],
                                       mask=vlan2ip[vlan][1],
@@ -140,8 +136,13 @@ def generate_network(dhcp, rack, server, nets):
     _vlan2net = vlan2net()
     tags = [i['vlan'] for i in network.values() if 'vlan' in i]
 
-    vlan2ip = dict((net.vlan_tag, (_get_ip(net), net.mask, net.gateway))
-                   for net in nets if net.vlan_tag in tags)
+    nets = [net for net in nets if net.vlan_tag in tags]
+    # All the server IPs are allocated at once
+    ips = dhcp.allocate_many(
+        rack, [(net, server.asset.serial,
+                mac_get(network, net.vlan_tag, server), '') for net in nets])
+    vlan2ip = dict((net.vlan_tag, (ip, net.mask, net.gateway))
+                   for net, ip in zip(nets, ips))
     return dict(net_item(v['vlan']) for v in network.values() if 'vlan' in v)
 
 
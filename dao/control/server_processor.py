@@ -15,6 +15,7 @@
 
 from dao.common import log
 from dao.control.db import api as db_api
+from dao.control.db import session_api
 from dao.control import worker_api
 
 LOG = log.getLogger(__name__)
@@ -62,15 +63,30 @@ class ServerProcessor(object):
         self.db.server_update(self.server, message[-253:])
 
     def s0_s1(self):
-        worker = worker_api.WorkerAPI.get_api(rack_name=self.server.rack_name)
-        worker.send('validate_server', self.server.id, self.server.lock_id)
-        return True
+        return self._dispatch('validate_server')
 
     def s1_s2(self):
-        worker = worker_api.WorkerAPI.get_api(rack_name=self.server.rack_name)
-        worker.send('provision_server', self.server.id, self.server.lock_id)
+        return self._dispatch('provision_server')
+
+    def _dispatch(self, action):
+        """ Persist task for the worker and notify it. Worker claims task
+        from DB, so task survives lost message or worker restart.
+        """
+        self.db.task_create(self.server, action)
+        # Worker must not be notified before the task is committed
+        session_api.on_commit(self._notify, action, self.server.rack_name,
+                              self.server.id, self.server.lock_id)
         return True
 
+    @staticmethod
+    def _notify(action, rack_name, sid, lock_id):
+        try:
+            worker = worker_api.WorkerAPI.get_api(rack_name=rack_name)
+            worker.send(action, sid, lock_id)
+        except Exception, exc:
+            LOG.warning('Notify worker on {0} for {1} failed: '
+                        '{2}'.format(action, sid, repr(exc)))
+
     def stop(self):
         if self.server.status in ('Validating', 'Provisioning'):
             worker = worker_api.WorkerAPI.get_api(
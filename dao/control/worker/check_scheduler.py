@@ -0,0 +1,95 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import random
+import time
+
+from dao.common import config
+
+
+opts = [
+    config.JSONOpt('worker', 'check_min_delay',
+                   default={'Validating': 30,
+                            'Provisioning': 60},
+                   help='Initial delay in seconds between completion checks '
+                        'of the server, per server status.'),
+
+    config.IntOpt('worker', 'check_max_delay',
+                  default=600,
+                  help='Maximum delay in seconds between completion checks '
+                       'of the server.'),
+]
+
+config.register(opts)
+CONF = config.get_config()
+
+
+class CheckScheduler(object):
+    """
+    Class keeps the time of the next completion check for every server.
+    Delay between checks grows exponentially while server is waiting in
+    the same status and is reset on external event (like boot callback).
+    """
+
+    def __init__(self):
+        # sid: (status, attempt, next_check)
+        self._schedule = dict()
+
+    def is_due(self, sid, status, now=None):
+        """ Check if server should be checked.
+        :type sid: int
+        :type status: str
+        :rtype: bool
+        """
+        now = now or time.time()
+        item = self._schedule.get(sid)
+        if item is None or item[0] != status:
+            # New server or new phase. Give it initial delay.
+            self._schedule[sid] = (status, 0, now + self._delay(status, 0))
+            return False
+        return item[2] <= now
+
+    def checked(self, sid, status, done):
+        """ Register check result.
+        :type sid: int
+        :type status: str
+        :param done: False if server is not ready yet
+        :type done: bool
+        """
+        if done:
+            self._schedule.pop(sid, None)
+            return
+        item = self._schedule.get(sid)
+        attempt = item[1] + 1 if item and item[0] == status else 0
+        self._schedule[sid] = (status, attempt,
+                               time.time() + self._delay(status, attempt))
+
+    def reset(self, sid, status):
+        """ External event arrived, make server due right now """
+        self._schedule[sid] = (status, 0, time.time())
+
+    def cleanup(self, sids):
+        """ Forget servers which are not in validation/provisioning anymore
+        :type sids: set
+        """
+        for sid in set(self._schedule).difference(sids):
+            self._schedule.pop(sid, None)
+
+    @staticmethod
+    def _delay(status, attempt):
+        base = CONF.worker.check_min_delay.get(status, 30)
+        delay = min(base * 2 ** attempt, CONF.worker.check_max_delay)
+        # Spread checks to avoid all the servers checked at once
+        return delay + random.uniform(0, delay / 10.0)
@@ -13,22 +13,103 @@
 # under the License.
 
 
+import collections
+import eventlet
 import itertools
 import netaddr
+import traceback
+from eventlet import event
+from eventlet import semaphore
 from dao.common import config
 from dao.common import log
 from dao.common import rpc
-from dao.common import utils
 from dao.control import exceptions
 from dao.control import server_helper
 from dao.control.db import api as db_api
 from dao.control.worker.dhcp import base
 
 
+opts = [
+    config.IntOpt('dhcp', 'reload_delay',
+                  default=1,
+                  help='Time in seconds DHCP agent reload is delayed to '
+                       'merge port changes into a single reload.'),
+
+    config.IntOpt('dhcp', 'resync_interval',
+                  default=3600,
+                  help='Interval in seconds of full resync of the subnets '
+                       'tracked by DHCP, 0 disables it. New subnets are '
+                       'registered as soon as they are used.'),
+]
+
+config.register(opts)
 CONF = config.get_config()
 LOG = log.getLogger(__name__)
 
 
+class ReloadResult(object):
+    """ Completion of a single DHCP agent reload shared by its callers """
+
+    def __init__(self):
+        self.changes = 0
+        self._done = event.Event()
+
+    def set(self, result):
+        self._done.send(result)
+
+    def wait(self):
+        """ Wait for reload and raise if it failed """
+        result = self._done.wait()
+        if isinstance(result, Exception):
+            raise exceptions.DAOException('Can not reload DHCP: {msg}'.
+                                          format(msg=repr(result)))
+        return result
+
+
+class ReloadScheduler(object):
+    """
+    Debounce reload_allocations calls to DHCP agent. All the changes
+    scheduled within dhcp.reload_delay are applied with one reload.
+    Helper is created before eventlet monkey patching, so green primitives
+    are used explicitly.
+    """
+
+    def __init__(self, dhcp_api, delay):
+        self.dhcp_api = dhcp_api
+        self.delay = delay
+        # Reloads are not run in parallel
+        self._reload_lock = semaphore.Semaphore()
+        self._pending = None
+
+    def schedule(self):
+        """ Register port change.
+        :return: reload which will cover the change
+        :rtype: ReloadResult
+        """
+        # No green thread switch below, so no lock is needed
+        if self._pending is None:
+            self._pending = ReloadResult()
+            eventlet.spawn_n(self._reload)
+        self._pending.changes += 1
+        return self._pending
+
+    def _reload(self):
+        eventlet.sleep(self.delay)
+        with self._reload_lock:
+            pending, self._pending = self._pending, None
+            try:
+                result = self.dhcp_api.call('reload_allocations')
+            except Exception, exc:
+                LOG.warning(traceback.format_exc())
+                result = exc
+            if isinstance(result, Exception):
+                LOG.warning('DHCP reload of %s changes failed: %r',
+                            pending.changes, result)
+            else:
+                LOG.info('DHCP reloaded, %s changes', pending.changes)
+            pending.set(result)
+
+
 class DHCPHelper(base.DHCPBase):
     def __init__(self, worker):
         # Init vlan tags supported by DHCP helpers
@@ -39,6 +120,13 @@ class DHCPHelper(base.DHCPBase):
         self.dhcp_api = rpc.RPCApi(CONF.dhcp.agent_url)
         self._worker = worker
         self._subnets = self._reinit_subnets()
+        # Green locks: they are held across DB calls
+        self._subnet_locks = collections.defaultdict(semaphore.Semaphore)
+        self._subnets_lock = semaphore.Semaphore()
+        self._reload = ReloadScheduler(self.dhcp_api, CONF.dhcp.reload_delay)
+        if CONF.dhcp.resync_interval:
+            # Helper is created before monkey patching, spawn green thread
+            eventlet.spawn_n(self._resync_loop)
 
     def allocate(self, rack, net, serial, mac, ip=''):
         """
@@ -49,46 +137,78 @@ class DHCPHelper(base.DHCPBase):
         :type ip: str
         :rtype: str
         """
-        net_type = self._ensure_subnet(net)
-        port = self._create_isc_port(net, rack.name, serial, mac, ip)
-        ip = port.ip
-        if net_type in ('ipmi', 'mgmt'):
-            result = self.dhcp_api.call('reload_allocations')
-            if isinstance(result, Exception):
-                raise exceptions.DAOException('Can not register DHCP: {msg}'.
-                                              format(msg=repr(result)))
-        return ip
+        return self.allocate_many(rack, [(net, serial, mac, ip)])[0]
 
-    @utils.Synchronized('dao.control.worker.dhcp.agent._create_isc_port')
-    def _create_isc_port(self, net, rack, serial, mac, ip):
+    def allocate_many(self, rack, requests):
+        """
+        :type rack: dao.control.db.model.Rack
+        :param requests: (net, serial, mac, ip) for every port
+        :type requests: list of tuple
+        :rtype: list of str
+        """
+        net_types = set(self._ensure_subnet(net)
+                        for net, _, _, _ in requests)
+        ports = self._create_isc_ports(rack.name, requests)
+        if net_types.intersection(('ipmi', 'mgmt')):
+            # Lease must be live before server is booted
+            self._reload.schedule().wait()
+        return [port.ip for port in ports]
+
+    def _create_isc_ports(self, rack, requests):
         """
         :type rack: str
+        :param requests: (net, serial, mac, ip) for every port
+        :type requests: list of tuple
+        :rtype: list of dao.control.db.model.Port
+        """
+        # Allocations in different subnets do not block each other,
+        # subnet row lock serializes them across processes.
+        locks = [self._subnet_locks[net_id] for net_id in
+                 sorted(set(net.id for net, _, _, _ in requests))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            # Only ports of the batch devices in this rack, see
+            # port_device_id_idx. Ports left in other racks are not reused.
+            serials = list(set(serial for _, serial, _, _ in requests))
+            existing = dict(((p.device_id, p.vlan_tag), p)
+                            for p in self.db.ports_list(rack_name=rack,
+                                                        device_id=serials))
+            result = [None] * len(requests)
+            new = []
+            for i, (net, serial, mac, ip) in enumerate(requests):
+                port = existing.get((serial, net.vlan_tag))
+                if port is None:
+                    first, last = self._ip_range(net)
+                    new.append((i, (serial, net.id, mac, first, last, ip)))
+                elif ip and port.ip != ip:
+                    raise exceptions.DAOConflict('Port is already created, '
+                                                 'IP mismatch: {0} instead '
+                                                 'of {1}'.format(port.ip, ip))
+                else:
+                    result[i] = port
+            ports = self.db.ports_allocate(rack, [r for _, r in new])
+            for (i, _), port in zip(new, ports):
+                result[i] = port
+            return result
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def _ip_range(net):
+        """
         :type net: dao.control.db.model.Subnet
-        :type serial: str
-        :type mac: str
-        :type ip: str
-        :rtype: dao.control.db.model.Port
-        """
-        ports = self.db.ports_list(vlan_tag=net.vlan_tag, rack_name=rack)
-        allocated = [p for p in ports if p.device_id == serial]
-        if allocated:
-            port = allocated[0]
-            if ip and port.ip != ip:
-                raise exceptions.DAOConflict('Port is already created, IP '
-                                             'mismatch: {0} instead of {1}'.
-                                             format(port.ip, ip))
-        else:
-            if not ip:
-                # TODO move this hardcode to config opt
-                first = (netaddr.IPAddress(net.first_ip).value -
-                         net.subnet.value
-                         if net.first_ip else CONF.dhcp.first_ip_offset)
-                subnet = net.subnet[first:CONF.dhcp.last_ip_offset]
-                ips = set(netaddr.IPAddress(p.ip) for p in ports)
-                ip = str(list(set(subnet).difference(ips))[0])
-            port = self.db.port_create(rack, serial, net.vlan_tag,
-                                       mac, ip, net.id)
-        return port
+        :return: first allocatable offset and the offset after the last one
+        :rtype: tuple(int, int)
+        """
+        # TODO move this hardcode to config opt
+        first = (netaddr.IPAddress(net.first_ip).value - net.subnet.value
+                 if net.first_ip else CONF.dhcp.first_ip_offset)
+        last = CONF.dhcp.last_ip_offset
+        if last < 0:
+            last += net.subnet.size
+        return first, last
 
     def delete_for_serial(self, serial, ignored=None):
         """
@@ -100,11 +220,9 @@ class DHCPHelper(base.DHCPBase):
         for port in ports:
             if ignored and port.vlan_tag == self.net2vlan[ignored]:
                 continue
-            self.db.object_delete(port)
-        result = self.dhcp_api.call('reload_allocations')
-        if isinstance(result, Exception):
-            raise exceptions.DAOException('Can not delete DHCP: {msg}'.
-                                          format(msg=repr(result)))
+            self.db.port_release(port)
+        # Nobody waits for the lease removal, failure is logged by reload
+        self._reload.schedule()
 
     def ensure_subnets(self, nets):
         """
@@ -116,11 +234,49 @@ class DHCPHelper(base.DHCPBase):
                 continue
             self._ensure_subnet(net)
 
-    @utils.Synchronized('dao.worker.dhcp_helper._ensure_subnet')
     def _ensure_subnet(self, subnet):
-        if subnet.id not in self._subnets:
-            self._subnets = self._reinit_subnets()
-        return self._subnets[subnet.id]
+        net_type = self._subnets.get(subnet.id)
+        if net_type is None:
+            # Registration of one subnet does not block the others
+            with self._subnet_locks[subnet.id]:
+                net_type = (self._subnets.get(subnet.id) or
+                            self._register_subnet(subnet))
+        return net_type
+
+    def _register_subnet(self, subnet):
+        """
+        Start tracking new subnet. DHCP is updated only if the subnet
+        belongs to the rack of this worker.
+        :type subnet: dao.control.db.model.Subnet
+        :return: network type
+        :rtype: str
+        """
+        net_type = server_helper.vlan2net()[subnet.vlan_tag]
+        try:
+            rack = self.db.rack_get_by_subnet_ip(subnet.ip)
+        except exceptions.DAONotFound:
+            rack = None
+        except exceptions.DAOManyFound:
+            # Still tracked, DHCP is updated for it by the full resync
+            LOG.warning('Subnet %s is shared by several racks, DHCP is not '
+                        'updated for it', subnet.ip)
+            rack = None
+        if rack is not None and rack.worker_id == self._worker.id:
+            self._reinit_dhcp([(rack.name, subnet)])
+        with self._subnets_lock:
+            self._subnets[subnet.id] = net_type
+        return net_type
+
+    def _resync_loop(self):
+        while True:
+            eventlet.sleep(CONF.dhcp.resync_interval)
+            try:
+                subnets = self._reinit_subnets()
+                # Merge, so subnets registered meanwhile are not lost
+                with self._subnets_lock:
+                    self._subnets.update(subnets)
+            except Exception:
+                LOG.warning(traceback.format_exc())
 
     def _reinit_subnets(self):
         """
@@ -56,6 +56,19 @@ class DHCPBase(object):
         """
         pass
 
+    def allocate_many(self, rack, requests):
+        """
+        Allocate IPs for several ports at once, e.g. for all the networks
+        of the server or for the whole rack.
+        :type rack: dao.control.db.model.Rack
+        :param requests: (net, serial, mac, ip) for every port
+        :type requests: list of tuple
+        :return: IP for every request
+        :rtype: list of str
+        """
+        return [self.allocate(rack, net, serial, mac, ip)
+                for net, serial, mac, ip in requests]
+
     @abc.abstractmethod
     def delete_for_serial(self, serial, ignored=None):
         """
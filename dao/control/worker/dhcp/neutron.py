@@ -65,56 +65,111 @@ class NeutronHelper(agent.DHCPHelper):
         :type mac: str
         :rtype: None
         """
-        net_type = self._ensure_subnet(net)
-        if net_type not in self.isc_nets and \
-                (CONF.dhcp.all_neutron or rack.neutron_dhcp):
-            mac = mac.replace('-', ':').lower()
-            port = self._create_port(net_type, rack.name,
-                                     serial, mac, ip,
-                                     pxe=self.pxe_net == net_type)
-            return port['fixed_ips'][0]['ip_address']
-        else:
-            return super(NeutronHelper, self).allocate(rack, net,
-                                                       serial, mac, ip)
-
-    def _create_port(self, net_name, rack_name, serial, mac, ip, pxe=False):
+        return self.allocate_many(rack, [(net, serial, mac, ip)])[0]
+
+    def allocate_many(self, rack, requests):
+        """
+        :type rack: dao.control.db.model.Rack
+        :param requests: (net, serial, mac, ip) for every port
+        :type requests: list of tuple
+        :rtype: list of str
+        """
+        result = [None] * len(requests)
+        isc, neutron = [], []
+        for i, (net, serial, mac, ip) in enumerate(requests):
+            net_type = self._ensure_subnet(net)
+            if net_type not in self.isc_nets and \
+                    (CONF.dhcp.all_neutron or rack.neutron_dhcp):
+                mac = mac.replace('-', ':').lower()
+                neutron.append((i, (net_type, serial, mac, ip)))
+            else:
+                isc.append((i, (net, serial, mac, ip)))
+        if neutron:
+            ports = self._create_ports(rack.name, [r for _, r in neutron])
+            for (i, _), port in zip(neutron, ports):
+                result[i] = port['fixed_ips'][0]['ip_address']
+        if isc:
+            ips = super(NeutronHelper, self).allocate_many(
+                rack, [r for _, r in isc])
+            for (i, _), ip in zip(isc, ips):
+                result[i] = ip
+        return result
+
+    def _create_ports(self, rack_name, requests):
+        """
+        Create missing ports with a single bulk request
+        :type rack_name: str
+        :param requests: (net_name, serial, mac, ip) for every port
+        :type requests: list of tuple
+        :rtype: list of dict
+        """
+        try:
+            return self._create_ports_once(rack_name, requests)
+        except Exception, exc:
+            if not neutron_helper.is_not_found(exc):
+                raise
+            # Cached network or subnet might be gone, reload and retry once
+            LOG.warning('Neutron object not found, reload topology: %s', exc)
+            neutron_helper.get_topology().invalidate()
+            return self._create_ports_once(rack_name, requests)
+
+    def _create_ports_once(self, rack_name, requests):
         neutron = self._get_client()
-        net_id = neutron.list_networks(name=net_name)['networks'][0]['id']
-        ports = neutron.list_ports(network_id=net_id, mac_address=mac)
-        if ports['ports']:
-            port = ports['ports'][0]
-            if port['device_owner'] not in ('', self.device_owner):
-                raise exceptions.DAOConflict('Port {0} in use, {1}'.format(
-                    ip, port['device_owner']))
-            old_ip = port['fixed_ips'][0]['ip_address']
-            if ip and old_ip != ip:
-                raise exceptions.DAOConflict('Port is already created, IP '
-                                             'mismatch: {0} instead of {1}'.
-                                             format(old_ip, ip))
-        else:
-            body = {'port': {'network_id': net_id,
-                             'admin_state_up': True,
-                             'mac_address': mac.replace('-', ':').lower(),
-                             'device_owner': self.device_owner,
-                             'device_id': serial}}
+        topology = neutron_helper.get_topology()
+        net2id = dict((r[0], topology.network_id(r[0])) for r in requests)
+        ports = neutron.list_ports(network_id=net2id.values(),
+                                   mac_address=[r[2] for r in requests])
+        existing = dict(((p['network_id'], p['mac_address']), p)
+                        for p in ports['ports'])
+        result = [None] * len(requests)
+        new, bodies = [], []
+        for i, (net_name, serial, mac, ip) in enumerate(requests):
+            net_id = net2id[net_name]
+            pxe = self.pxe_net == net_name
+            port = existing.get((net_id, mac))
+            if port:
+                if port['device_owner'] not in ('', self.device_owner):
+                    raise exceptions.DAOConflict('Port {0} in use, {1}'.
+                                                 format(ip,
+                                                        port['device_owner']))
+                old_ip = port['fixed_ips'][0]['ip_address']
+                if ip and old_ip != ip:
+                    raise exceptions.DAOConflict('Port is already created, '
+                                                 'IP mismatch: {0} instead '
+                                                 'of {1}'.format(old_ip, ip))
+                if pxe:
+                    port_req_body = {'port': {
+                        'extra_dhcp_opts': self._pxe_options()}}
+                    neutron.update_port(port['id'], port_req_body)
+                result[i] = port
+                continue
+            body = {'network_id': net_id,
+                    'admin_state_up': True,
+                    'mac_address': mac,
+                    'device_owner': self.device_owner,
+                    'device_id': serial}
             if ip:
-                body['port']['fixed_ips'] = [{'ip_address': ip}]
+                body['fixed_ips'] = [{'ip_address': ip}]
             else:
-                subnet = neutron.list_subnets(
-                    network_id=net_id,
-                    name=rack_name.lower())['subnets'][0]
-                body['port']['fixed_ips'] = [{'subnet_id': subnet['id']}]
-            port = neutron.create_port(body)['port']
-        if pxe:
-            options = [{'opt_name': 'bootfile-name',
-                        'opt_value': 'pxelinux.0'},
-                       {'opt_name': 'server-ip-address',
-                        'opt_value': self.tftp_url},
-                       {'opt_name': 'tftp-server',
-                        'opt_value': self.tftp_url}]
-            port_req_body = {'port': {'extra_dhcp_opts': options}}
-            neutron.update_port(port['id'], port_req_body)
-        return port
+                subnet_id = topology.subnet_id(net_name, rack_name.lower())
+                body['fixed_ips'] = [{'subnet_id': subnet_id}]
+            if pxe:
+                body['extra_dhcp_opts'] = self._pxe_options()
+            new.append(i)
+            bodies.append(body)
+        if bodies:
+            created = neutron.create_port({'ports': bodies})['ports']
+            for i, port in zip(new, created):
+                result[i] = port
+        return result
+
+    def _pxe_options(self):
+        return [{'opt_name': 'bootfile-name',
+                 'opt_value': 'pxelinux.0'},
+                {'opt_name': 'server-ip-address',
+                 'opt_value': self.tftp_url},
+                {'opt_name': 'tftp-server',
+                 'opt_value': self.tftp_url}]
 
     def delete_for_serial(self, serial, ignored=None):
         """
@@ -123,11 +178,8 @@ class NeutronHelper(agent.DHCPHelper):
         :rtype: None
         """
         neutron = self._get_client()
-        if ignored:
-            skip = neutron.list_networks(name=ignored)['networks']
-            skip = [0]['id'] if skip else None
-        else:
-            skip = None
+        networks = neutron_helper.get_topology().networks()
+        skip = networks[ignored]['id'] if ignored in networks else None
         ports = neutron.list_ports(device_id=serial,
                                    device_owner=self.device_owner)
         for port in ports['ports']:
@@ -148,12 +200,18 @@ class NeutronHelper(agent.DHCPHelper):
         # Generate data
         vlan2net = server_helper.vlan2net()
         client = self._get_client()
-        net2network = neutron_helper.networks_get(client)
+        topology = neutron_helper.get_topology()
+        net2network = topology.networks()
         for rack, db_subnet in rack2net:
             net_name = vlan2net[db_subnet.vlan_tag]
             if net_name in self.isc_nets:
                 continue
             n_network = net2network[net_name]
+            if rack.lower() not in n_network['subnets']:
+                # Cache might be stale, check neutron before creating
+                topology.invalidate()
+                net2network = topology.networks()
+                n_network = net2network[net_name]
             if rack.lower() not in n_network['subnets']:
                 neutron_helper.create_subnet(client, rack,
                                              n_network, db_subnet)
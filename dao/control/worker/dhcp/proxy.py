@@ -0,0 +1,61 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from dao.common import config
+from dao.common import rpc
+from dao.control.worker.dhcp import base
+
+
+CONF = config.get_config()
+
+
+class DHCPProxy(base.DHCPBase):
+    """
+    DHCP helper of the worker shard process. DHCP is managed by the router
+    process only (see worker.supervisor.Router), so DHCP agent is updated
+    and reloaded from the single place.
+    """
+
+    def __init__(self, db):
+        """
+        :type db: dao.control.db.api.Driver
+        """
+        self.db = db
+        self._api = None
+
+    def allocate(self, rack, net, serial, mac, ip=''):
+        return self.allocate_many(rack, [(net, serial, mac, ip)])[0]
+
+    def allocate_many(self, rack, requests):
+        requests = [(net.id, serial, mac, ip)
+                    for net, serial, mac, ip in requests]
+        return self._call('dhcp_allocate_many', rack.name, requests)
+
+    def delete_for_serial(self, serial, ignored=None):
+        return self._call('dhcp_delete_for_serial', serial, ignored)
+
+    def ensure_subnets(self, nets):
+        return self._call('dhcp_ensure_subnets', [net.id for net in nets])
+
+    def _call(self, function, *args):
+        if self._api is None:
+            # Router registers its url after shard processes are started
+            worker = self.db.worker_get(name=CONF.worker.name,
+                                        location=CONF.common.location)
+            self._api = rpc.RPCApi(worker.url)
+        result = self._api.call(function, *args)
+        if isinstance(result, Exception):
+            raise result
+        return result
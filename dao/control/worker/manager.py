@@ -16,7 +16,11 @@
 import eventlet
 import json
 import netaddr
+import os
 import requests
+import signal
+import socket
+import time
 import traceback
 
 from dao.common import config
@@ -28,10 +32,16 @@ from dao.control import server_helper
 from dao.control import server_processor
 from dao.control import sku
 from dao.control.db import api as db_api
+from dao.control.db import change_log
+from dao.control.db import session_api
+from dao.control.worker import check_scheduler
 from dao.control.worker import discovery
 from dao.control.worker import provisioning
 from dao.control.worker import rack_discover
+from dao.control.worker import sharding
+from dao.control.worker import supervisor
 from dao.control.worker.dhcp import base as dhcp_helper
+from dao.control.worker.dhcp import proxy as dhcp_proxy
 from dao.control.worker.hooks import base as hook_base
 from dao.control.worker.switch import base as switch_base
 from dao.control.worker.validation import helper as validation_helper
@@ -53,6 +63,28 @@ opts = [
                   default=5000,
                   help='Port number of validation agent.'),
 
+    config.IntOpt('worker', 'task_lease',
+                  default=600,
+                  help='Time in seconds task is leased to the worker process. '
+                       'Lease is extended while task is running, task with '
+                       'expired lease is claimed again.'),
+
+    config.IntOpt('worker', 'task_max_attempts',
+                  default=3,
+                  help='Number of attempts to run task before server is '
+                       'released with an error.'),
+
+    config.IntOpt('worker', 'lock_lease',
+                  default=120,
+                  help='Time in seconds server lock is leased to the worker '
+                       'process. Lease is extended while server is '
+                       'processed.'),
+
+    config.IntOpt('worker', 'check_interval',
+                  default=10,
+                  help='Interval in seconds between sweeps of '
+                       'validating/provisioning servers. Every server is '
+                       'checked according to its own schedule.'),
 ]
 
 config.register(opts)
@@ -61,7 +93,18 @@ CONF = config.get_config()
 LOG = log.getLogger(__name__)
 
 
+def process_owner():
+    """ Unique name of the worker process used as a lock/task owner """
+    return '{0}:{1}:{2}'.format(CONF.worker.name, socket.gethostname(),
+                                os.getpid())
+
+
 class ServerLock(object):
+    """ Lock server for processing. Lock is kept in DB as a lease, so
+    several worker processes may process servers of the same racks.
+    Locally locked servers are tracked to be able to stop processing and to
+    heartbeat leases (see ServerLock.heartbeat).
+    """
     locked_keys = dict()
 
     def __init__(self, sid):
@@ -72,9 +115,28 @@ class ServerLock(object):
             raise exceptions.DAOConflict('Server {0} is processed'.
                                          format(self.sid))
         self.locked_keys[self.sid] = eventlet.greenthread.getcurrent()
+        try:
+            db_api.Driver.server_lock_acquire(self.sid, process_owner(),
+                                              CONF.worker.lock_lease)
+        except Exception:
+            self.locked_keys.pop(self.sid)
+            raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.locked_keys.pop(self.sid)
+        try:
+            db_api.Driver.server_lock_release(self.sid, process_owner())
+        finally:
+            self.locked_keys.pop(self.sid)
+
+    @classmethod
+    def heartbeat(cls):
+        """ Extend leases of all the servers locked by the process """
+        sids = list(cls.locked_keys)
+        count = db_api.Driver.server_locks_extend(sids, process_owner(),
+                                                  CONF.worker.lock_lease)
+        if count != len(sids):
+            LOG.warning('Only %s of %s server locks extended',
+                        count, len(sids))
 
 
 class Manager(rpc.RPCServer):
@@ -84,18 +146,50 @@ class Manager(rpc.RPCServer):
     1. Lock servers to prevent event racing (see track_server, Manager._spawn
     and for example Manager.validate).
     2. Have periodic logic (Manager._periodic_runner)
+    3. Claim validation/provisioning tasks from DB (Manager._claim_tasks)
     """
-    def __init__(self):
-        super(Manager, self).__init__(CONF.worker.port)
+    def __init__(self, shard=None, ring=None):
+        """
+        :param shard: index of the child process if worker is sharded
+        :type shard: int
+        :type ring: sharding.HashRing
+        """
+        if shard is None:
+            port = CONF.worker.port
+        else:
+            port = str(int(CONF.worker.port) + 1 + shard)
+        super(Manager, self).__init__(port)
         self.db = db_api.Driver()
-        self.worker = self.db.worker_register(CONF.worker.name, self.url,
-                                              CONF.common.location)
-        self.dhcp = dhcp_helper.DHCPBase.get_helper(self.worker)
+        self.shard = shard
+        self.ring = ring
+        if shard is None:
+            self.worker = self.db.worker_register(CONF.worker.name, self.url,
+                                                  CONF.common.location)
+        else:
+            # Worker is registered by supervisor with the router url
+            self.worker = self.db.worker_get(name=CONF.worker.name,
+                                             location=CONF.common.location)
+        self.owner = process_owner()
+        if shard is None:
+            self.dhcp = dhcp_helper.DHCPBase.get_helper(self.worker)
+        else:
+            # DHCP of all the shards is managed by the router process
+            self.dhcp = dhcp_proxy.DHCPProxy(self.db)
+            dhcp_helper.DHCPBase.instance = self.dhcp
         self.provision = provisioning.get_driver(self.url)
         self.discovery = discovery.Discovery(self.worker,
                                              self.dhcp)
         self.vlan2net = server_helper.vlan2net()
         self._switch = switch_base.Base.get_helper(self.db)
+        self._sweep_stats = dict()
+        self._scheduler = check_scheduler.CheckScheduler()
+
+    def owns_rack(self, rack_name):
+        """ Check if rack is processed by the process
+        :type rack_name: str
+        :rtype: bool
+        """
+        return self.ring is None or self.ring.get_node(rack_name) == self.shard
 
     @staticmethod
     def stop_server(sid, lock_id):
@@ -112,6 +206,38 @@ class Manager(rpc.RPCServer):
         else:
             return False
 
+    def check_server(self, sid, lock_id):
+        """ Check right away if server completed validation/provisioning.
+        Is called on server boot callback instead of waiting for the
+        periodic check.
+        :param sid: Server ID
+        :param lock_id: Lock id field from Server
+        :rtype: bool
+        """
+        server = self.db.server_get_by(id=sid, lock_id=lock_id)
+        func_name = self._status2check().get(server.status)
+        if func_name is None or sid in ServerLock.locked_keys:
+            return False
+        self._scheduler.reset(sid, server.status)
+        self._spawn(None, self._run_check.__name__,
+                    (func_name, sid, lock_id, server.status), {})
+        return True
+
+    def _run_check(self, func_name, sid, lock_id, status):
+        """ Run completion check and schedule the next one.
+        :param func_name: self._check_validated or self._check_provisioned
+        :param sid: Server ID
+        :param lock_id: Lock id field from Server
+        :param status: Server status check is started for
+        """
+        # Failed check (lock conflict, DB error) is retried with backoff,
+        # servers which left the status are dropped by the sweep cleanup
+        done = False
+        try:
+            done = getattr(self, func_name)(sid, lock_id)
+        finally:
+            self._scheduler.checked(sid, status, done)
+
     def rack_discover(self, switch_name, ip, create):
 
         switch = self._switch.switch_discover(switch_name, ip)
@@ -176,6 +302,7 @@ class Manager(rpc.RPCServer):
     def rack_renumber(self, rack_name, fake):
         """ Generate server number and rack unit """
         servers = self.db.servers_get_by(**{'asset.rack.name': rack_name})
+        changed = []
         for index, s in enumerate(servers):
             if s.asset.status != 'Discovered':
                 continue
@@ -186,9 +313,21 @@ class Manager(rpc.RPCServer):
                     s.asset.rack, 'mgmt', s.pxe_mac)
             s.server_number = str(s_number)
             s.rack_unit = u_number
-            self.db.server_update(s)
+            changed.append(s)
+        _, conflicts = self.db.servers_update_bulk(changed)
+        for s in conflicts:
+            LOG.warning('Server %s was changed concurrently, not renumbered',
+                        s.name)
 
     def validate_server(self, sid, lock_id):
+        """ Claim validation task and start server validation
+        (see self._validate_server)
+        :param sid: Server ID
+        :param lock_id: Lock id field from Server
+        """
+        self._task_claim_and_run(self.validate_server.__name__, sid, lock_id)
+
+    def _validate_server(self, sid, lock_id):
         """ Start server validation
         1. Validate switch for the rack server belongs to
         2. Run scripts to update/validate IPMI
@@ -231,7 +370,8 @@ class Manager(rpc.RPCServer):
         Parameters:
         :param sid: Server ID
         :param lock_id: Lock id field from Server
-        :rtype: None
+        :return: False if server is not ready yet
+        :rtype: bool
         """
         with ServerLock(sid):
             server = self.db.server_get_by(id=sid, lock_id=lock_id)
@@ -255,14 +395,17 @@ class Manager(rpc.RPCServer):
                 server_processor.ServerProcessor(server).next()
             except exceptions.DAOIgnore, exc:
                 # Server is not ready yet. Will try next time
-                server.message = exc.message
-                self.db.update(server)
+                if server.message != exc.message:
+                    server.message = exc.message
+                    self.db.update(server)
+                return False
             except Exception, exc:
                 LOG.warning(traceback.format_exc())
                 if isinstance(exc, KeyError):
                     exc.message = 'KeyError: {0}'.format(exc.message)
                 server = self._reload_server_record(server)
                 server_processor.ServerProcessor(server).error(exc.message)
+            return True
 
     def _run_validation_scripts(self, server):
         """ Run validation scripts
@@ -313,6 +456,15 @@ class Manager(rpc.RPCServer):
             raise exceptions.DAOException(result.text)
 
     def provision_server(self, sid, lock_id):
+        """ Claim provisioning task and start server provisioning
+        (see self._provision_server)
+        :param sid: Server ID
+        :param lock_id: Lock id field from Server
+        """
+        self._task_claim_and_run(self.provision_server.__name__,
+                                 sid, lock_id)
+
+    def _provision_server(self, sid, lock_id):
         """ Configure provisioning tool to provision server with a final image
         and restart server
 
@@ -348,31 +500,135 @@ class Manager(rpc.RPCServer):
                 server_processor.ServerProcessor(server).error(exc.message)
                 raise
 
+    def _task_claim_and_run(self, action, sid, lock_id):
+        """ Claim task for the server and run it. Task might be claimed by
+        periodic runner already.
+        """
+        try:
+            task = self.db.task_claim_for(sid, lock_id, action,
+                                          self.owner, CONF.worker.task_lease)
+        except exceptions.DAONotFound:
+            # Server was dispatched without task
+            return getattr(self, '_' + action)(sid, lock_id)
+        except exceptions.DAOConflict, exc:
+            LOG.debug('Task for %s is not claimed: %s', sid, exc.message)
+            return
+        self._task_execute(task)
+
+    def _task_execute(self, task):
+        """ Run task keeping its lease alive.
+        :type task: dao.control.db.model.Task
+        """
+        heartbeat = eventlet.spawn(self._task_heartbeat, task)
+        state, message = 'Done', ''
+        try:
+            getattr(self, '_' + task.action)(task.server_id, task.lock_id)
+        except Exception, exc:
+            state, message = 'Failed', str(exc.message)
+            raise
+        finally:
+            heartbeat.kill()
+            if state == 'Done':
+                self.db.task_finish(task, state, message)
+            else:
+                self._task_failed(task, message)
+
+    def _task_heartbeat(self, task):
+        lease = CONF.worker.task_lease
+        while True:
+            eventlet.sleep(lease / 3)
+            self.db.task_extend(task, lease)
+
+    def _claim_tasks(self):
+        """ Periodic function that claims tasks not processed by anybody:
+        notification is lost or worker process is restarted.
+        """
+        racks = None
+        if self.ring is not None:
+            racks = [rack.name for rack in self.db.racks_get_by_worker(
+                self.worker) if self.owns_rack(rack.name)]
+        tasks = self.db.tasks_claim(self.worker, self.owner,
+                                    CONF.worker.task_lease, racks=racks)
+        for task in tasks:
+            if task.attempts > CONF.worker.task_max_attempts:
+                self._task_abandon(task)
+            else:
+                LOG.info('Task %s claimed: %s for %s, attempt %s', task.id,
+                         task.action, task.server_id, task.attempts)
+                self.pool.spawn_n(self._task_run, task)
+
+    def _task_run(self, task):
+        try:
+            self._task_execute(task)
+        except Exception:
+            LOG.warning(traceback.format_exc())
+
+    def _task_failed(self, task, message):
+        """ Requeue failed task while attempts are left. Task is retried
+        only if server is still dispatched under its lock_id, i.e. action
+        failed before server was released with an error.
+        :type task: dao.control.db.model.Task
+        :type message: str
+        """
+        try:
+            server = self.db.server_get_by(id=task.server_id,
+                                           lock_id=task.lock_id)
+        except exceptions.DAONotFound:
+            self.db.task_finish(task, 'Failed', message)
+            return
+        if task.attempts < CONF.worker.task_max_attempts:
+            LOG.info('Task %s failed on attempt %s, requeued: %s',
+                     task.id, task.attempts, message)
+            self.db.task_requeue(task, message)
+            return
+        msg = 'Task {0} failed after {1} attempts: {2}'.format(
+            task.action, task.attempts, message)
+        self.db.task_finish(task, 'Failed', msg)
+        server_processor.ServerProcessor(server).error(msg)
+
+    def _task_abandon(self, task):
+        msg = 'Task {0} failed after {1} attempts'.format(
+            task.action, task.attempts - 1)
+        self.db.task_finish(task, 'Failed', msg)
+        try:
+            server = self.db.server_get_by(id=task.server_id,
+                                           lock_id=task.lock_id)
+            server_processor.ServerProcessor(server).error(msg)
+        except exceptions.DAONotFound:
+            pass
+
     def _check_provisioned(self, sid, lock_id):
         """ Function called periodically (from self._check_state) in a green
         thread to check if server is provisioned to target image.
         Parameters:
         :param sid: Server ID
         :param lock_id: Lock id field from Server
-        :rtype: None
+        :return: False if server is not ready yet
+        :rtype: bool
         """
         with ServerLock(sid):
             server = self.db.server_get_by(id=sid, lock_id=lock_id)
             try:
+                # Transaction is not held across the provisioning tool call
                 done, msg = self.provision.is_provisioned(
                     server, CONF.worker.fqdn_net)
                 if done:
                     server.status = 'Provisioned'
-                    self.db.server_update(server)
-                    server_processor.ServerProcessor(server).next()
+                    with session_api.unit_of_work():
+                        self.db.server_update(server)
+                        server_processor.ServerProcessor(server).next()
                     hook_base.HookBase.get_hook(server, self.db).provisioned()
                 else:
                     if server.message != msg:
                         self.db.server_update(server, msg)
+                    return False
             except Exception, exc:
                 msg = str(traceback.format_exc())
                 LOG.warning('Error: %s, msg is %s', server.name, msg)
+                # Changes of the failed unit of work are rolled back
+                server = self.db.server_get_by(id=sid, lock_id=lock_id)
                 server_processor.ServerProcessor(server).error(exc.message)
+            return True
 
     def _prepare_server(self, server, status):
         """ Prepare server for provisioning
@@ -410,64 +666,107 @@ class Manager(rpc.RPCServer):
         status = {}
         return status
 
+    def sweep_stats(self):
+        """Return statistics of the last periodic state sweep.
+        :returns: dict
+        """
+        return self._sweep_stats
+
     def do_main(self):
         """ Function is an entry point for manager.
         Start periodic enventlet task and pass control to RPC."""
         self.pool.spawn_n(self._periodic_runner)
+        self.pool.spawn_n(self._lock_heartbeat)
         super(Manager, self).do_main()
 
     def _periodic_runner(self):
         """ Function is called in a green thread to perform periodic actions
         for manager"""
         while True:
+            try:
+                self._claim_tasks()
+            except Exception:
+                LOG.warning(traceback.format_exc())
             try:
                 self._check_state()
             except Exception:
                 traceback.print_exc()
                 LOG.warning(traceback.format_exc())
-            eventlet.sleep(30)
+            eventlet.sleep(CONF.worker.check_interval)
+
+    @staticmethod
+    def _lock_heartbeat():
+        """ Function is called in a green thread to keep server locks """
+        while True:
+            eventlet.sleep(CONF.worker.lock_lease / 3)
+            try:
+                ServerLock.heartbeat()
+            except Exception:
+                LOG.warning(traceback.format_exc())
+
+    def _status2check(self):
+        return {'Validating': self._check_validated.__name__,
+                'Provisioning': self._check_provisioned.__name__}
 
     def _check_state(self):
         """ Periodic function that pull all servers in a validation/provisioning
         state and start green thread with a code to ensure if process is
         completed"""
-        self._run_check_by_status('Validating', self._check_validated.__name__)
-        self._run_check_by_status('Provisioning',
-                                  self._check_provisioned.__name__)
+        self._run_check_by_status(self._status2check())
 
-    def _run_check_by_status(self, status, func_name):
+    def _run_check_by_status(self, status2func):
         """ Extention for self._check_state function.
-        :param status: Which status should be used as a filter for servers to
-        be processed
-        :param func_name: function to be called to check if
-        validation/provisioning process completed
+        All the servers of the worker are requested with a single query.
+        :param status2func: Which status should be used as a filter for
+        servers to be processed mapped to the function to be called to check
+        if validation/provisioning process completed
+        :type status2func: dict
         :return: None
         """
-        racks = self.db.racks_get_by_worker(self.worker)
-        for rack in racks:
-            servers = self.db.servers_get_by(**{'asset.rack.id': rack.id,
-                                                'status': status})
-            for server in servers:
-                if server.id in ServerLock.locked_keys:
-                    continue
-                if server.meta.get('ironicated', False):
-                    continue
-                try:
-                    self._spawn(None, func_name, (server.id,
-                                                  server.lock_id), {})
-                except exceptions.DAONotFound, exc:
-                    LOG.warning(traceback.format_exc())
-                    server_processor.ServerProcessor(server).error(exc.message)
-                except Exception:
-                    LOG.warning(traceback.format_exc())
+        started = time.time()
+        servers = self.db.servers_get_for_check(self.worker,
+                                                status2func.keys())
+        duration = time.time() - started
+        checked = 0
+        self._scheduler.cleanup(set(server[0] for server in servers))
+        for sid, lock_id, status, meta, rack_name in servers:
+            if not self.owns_rack(rack_name):
+                continue
+            if sid in ServerLock.locked_keys:
+                continue
+            if meta and meta.get('ironicated', False):
+                continue
+            if not self._scheduler.is_due(sid, status):
+                continue
+            try:
+                self._spawn(None, self._run_check.__name__,
+                            (status2func[status], sid, lock_id, status), {})
+                checked += 1
+            except exceptions.DAONotFound, exc:
+                LOG.warning(traceback.format_exc())
+                server = self.db.server_get_by(id=sid)
+                server_processor.ServerProcessor(server).error(exc.message)
+            except Exception:
+                LOG.warning(traceback.format_exc())
+        self._sweep_stats = dict(started=started, duration=duration,
+                                 rows=len(servers), checked=checked)
+        # Sweep is run every check_interval, idle ones are logged as debug
+        report = LOG.info if checked else LOG.debug
+        report('State sweep: %s servers fetched in %.3f sec, %s checks '
+               'started', len(servers), duration, checked)
 
 
 def run():
     LOG.info('Started')
     try:
+        if CONF.worker.processes > 1:
+            supervisor.Supervisor(CONF.worker.processes).run()
+            return
+        signal.signal(signal.SIGTERM, supervisor.terminate)
         manager = Manager()
         eventlet.monkey_patch()
-        manager.do_main()
+        supervisor.serve(manager)
+        change_log.stop()
     except Exception:
         LOG.warning(traceback.format_exc())
         raise
@@ -14,23 +14,141 @@
 
 
 import eventlet
+import os
+import traceback
+from eventlet import semaphore
 from dao.common import config
+from dao.common import log
 
 clientv20 = eventlet.import_patched('neutronclient.v2_0.client')
 
 
+opts = [
+    config.IntOpt('openstack', 'topology_refresh',
+                  default=300,
+                  help='Interval in seconds cached neutron networks and '
+                       'subnets are refreshed in background.'),
+]
+
+config.register(opts)
 CONF = config.get_config()
+LOG = log.getLogger(__name__)
+
+_CLIENT = None
+_TOPOLOGY = None
+_LOCK = semaphore.Semaphore()
 
 
 def get_client():
-    neutron = clientv20.Client(
-        auth_url=CONF.openstack.auth_url,
-        region_name=CONF.openstack.region,
-        username=CONF.openstack.username,
-        password=CONF.openstack.password,
-        tenant_name=CONF.openstack.project,
-        insecure=CONF.openstack.insecure)
-    return neutron
+    """ Return process wide client. Client keeps keystone token and
+    reauthenticates when it expires.
+    :rtype: clientv20.Client
+    """
+    global _CLIENT
+    with _LOCK:
+        # Connections must not be shared with forked processes
+        if _CLIENT is None or _CLIENT[0] != os.getpid():
+            _CLIENT = (os.getpid(), new_client())
+        return _CLIENT[1]
+
+
+def new_client():
+    """
+    :rtype: clientv20.Client
+    """
+    return clientv20.Client(auth_url=CONF.openstack.auth_url,
+                            region_name=CONF.openstack.region,
+                            username=CONF.openstack.username,
+                            password=CONF.openstack.password,
+                            tenant_name=CONF.openstack.project,
+                            insecure=CONF.openstack.insecure)
+
+
+def is_not_found(exc):
+    """ Return True if neutron replied 404 to the request
+    :type exc: Exception
+    :rtype: bool
+    """
+    return getattr(exc, 'status_code', None) == 404
+
+
+def get_topology():
+    """ Return process wide topology cache
+    :rtype: Topology
+    """
+    global _TOPOLOGY
+    with _LOCK:
+        if _TOPOLOGY is None or _TOPOLOGY.pid != os.getpid():
+            _TOPOLOGY = Topology(CONF.openstack.topology_refresh)
+    return _TOPOLOGY
+
+
+class Topology(object):
+    """
+    Cache of neutron networks and their subnets, see networks_get.
+    It is refreshed in background and should be invalidated when
+    networks or subnets are created or deleted.
+    """
+
+    def __init__(self, interval):
+        self.pid = os.getpid()
+        self.interval = interval
+        self._networks = None
+        self._lock = semaphore.Semaphore()
+        if interval:
+            eventlet.spawn_n(self._run)
+
+    def networks(self):
+        """
+        :rtype: dict(net_name, network_dict)
+        """
+        networks = self._networks
+        if networks is None:
+            with self._lock:
+                if self._networks is None:
+                    self._networks = networks_get(get_client())
+                networks = self._networks
+        return networks
+
+    def network_id(self, net_name):
+        """ Return id of the network, reload the cache if it is unknown
+        :type net_name: str
+        :rtype: str
+        """
+        networks = self.networks()
+        if net_name not in networks:
+            self.invalidate()
+            networks = self.networks()
+        return networks[net_name]['id']
+
+    def subnet_id(self, net_name, subnet_name):
+        """ Return id of the subnet, reload the cache if it is unknown
+        :type net_name: str
+        :type subnet_name: str
+        :rtype: str
+        """
+        subnets = self.networks()[net_name]['subnets']
+        if subnet_name not in subnets:
+            self.invalidate()
+            subnets = self.networks()[net_name]['subnets']
+        return subnets[subnet_name]['id']
+
+    def invalidate(self):
+        self._networks = None
+
+    def _run(self):
+        # Refresher has its own client to not interleave its requests
+        # with the ones of the process wide client
+        client = None
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                client = client or new_client()
+                networks = networks_get(client)
+                with self._lock:
+                    self._networks = networks
+            except Exception:
+                LOG.warning(traceback.format_exc())
 
 
 def networks_get(client):
@@ -77,4 +195,6 @@ def create_subnet(client, rack_name, n_network, db_subnet):
     ref_dict['allocation_pools'] = [pools]
     if n_network['name'] == dhcp_net:
         ref_dict['enable_dhcp'] = True
-    return client.create_subnet({'subnet': ref_dict})
+    subnet = client.create_subnet({'subnet': ref_dict})
+    get_topology().invalidate()
+    return subnet
@@ -0,0 +1,66 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import bisect
+import hashlib
+
+from dao.common import config
+
+
+opts = [
+    config.IntOpt('worker', 'processes',
+                  default=1,
+                  help='Number of worker processes. If more than 1, worker '
+                       'racks are sharded across child processes.'),
+
+    config.IntOpt('worker', 'shard_replicas',
+                  default=64,
+                  help='Number of points every process has on the hash '
+                       'ring.'),
+]
+
+config.register(opts)
+CONF = config.get_config()
+
+
+class HashRing(object):
+    """
+    Consistent hashing of rack names to worker processes, so changing
+    number of processes moves as few racks as possible.
+    """
+
+    def __init__(self, nodes, replicas=None):
+        """
+        :type nodes: list of int
+        :type replicas: int
+        """
+        replicas = replicas or CONF.worker.shard_replicas
+        points = [(self._hash('{0}-{1}'.format(node, i)), node)
+                  for node in nodes for i in range(replicas)]
+        points.sort()
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        """
+        :type key: str
+        :rtype: int
+        """
+        index = bisect.bisect(self._keys, self._hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
@@ -0,0 +1,268 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import eventlet
+import netaddr
+import os
+import signal
+import time
+import traceback
+
+from dao.common import config
+from dao.common import log
+from dao.common import rpc
+from dao.common import utils
+
+from dao.control import server_helper
+from dao.control.db import api as db_api
+from dao.control.db import change_log
+from dao.control.db import session_api
+from dao.control.worker import sharding
+from dao.control.worker.dhcp import base as dhcp_base
+
+
+CONF = config.get_config()
+LOG = log.getLogger(__name__)
+
+
+_STOP = []
+
+
+def terminate(signum, frame):
+    """ SIGTERM handler of worker processes. Handler may interrupt any
+    green thread, even one holding a DB connection, so it only records
+    the signal and process is stopped by serve.
+    """
+    _STOP.append(signum)
+
+
+def serve(child):
+    """ Run child.do_main in a green thread until SIGTERM arrives.
+    Caller must flush the change log since os._exit skips atexit handlers.
+    :type child: rpc.RPCServer
+    """
+    main = eventlet.spawn(child.do_main)
+    while not _STOP:
+        if main.dead:
+            main.wait()
+            raise RuntimeError('Worker process exited')
+        eventlet.sleep(1)
+
+
+class Router(rpc.RPCServer):
+    """
+    RPC server listening on the worker port. Every request is forwarded to
+    the child process owning the rack request is related to.
+    """
+
+    def __init__(self, ring, urls):
+        """
+        :type ring: sharding.HashRing
+        :param urls: child process urls, index is a shard number
+        :type urls: list of str
+        """
+        super(Router, self).__init__(CONF.worker.port)
+        self.db = db_api.Driver()
+        self.ring = ring
+        self.urls = urls
+        self.worker = self.db.worker_register(CONF.worker.name, self.url,
+                                              CONF.common.location)
+        # Router is the only process managing DHCP, see dhcp.proxy
+        self.dhcp = dhcp_base.DHCPBase.get_helper(self.worker)
+
+    def _api(self, rack_name):
+        shard = 0 if rack_name is None else self.ring.get_node(rack_name)
+        return rpc.RPCApi(self.urls[shard])
+
+    @utils.CacheIt(60, ignore_self=True)
+    def _rack_by_sid(self, sid):
+        return self.db.server_get_by(id=sid).rack_name
+
+    @utils.CacheIt(180, ignore_self=True)
+    def _ipmi_subnets_get(self):
+        return self.db.subnets_get_by(vlan_tag=CONF.worker.net2vlan['ipmi'])
+
+    @utils.CacheIt(180, ignore_self=True)
+    def _rack_by_net_ip(self, net_ip):
+        return self.db.rack_get_by_subnet_ip(net_ip).name
+
+    def _rack_by_ip(self, ip):
+        """ Return name of the rack IPMI subnet of ip belongs to, same way
+        as Discovery.dhcp_hook does, or None if there is no such rack.
+        """
+        try:
+            _ip = netaddr.IPAddress(ip)
+            ipmi_net = [net for net in self._ipmi_subnets_get()
+                        if _ip in net.subnet][0]
+            return self._rack_by_net_ip(ipmi_net.ip)
+        except Exception:
+            LOG.debug(traceback.format_exc())
+            return None
+
+    def check_server(self, sid, lock_id):
+        return self._api(self._rack_by_sid(sid)).send(
+            'check_server', sid, lock_id)
+
+    def stop_server(self, sid, lock_id):
+        return self._api(self._rack_by_sid(sid)).call(
+            'stop_server', sid, lock_id)
+
+    def validate_server(self, sid, lock_id):
+        return self._api(self._rack_by_sid(sid)).send(
+            'validate_server', sid, lock_id)
+
+    def provision_server(self, sid, lock_id):
+        return self._api(self._rack_by_sid(sid)).send(
+            'provision_server', sid, lock_id)
+
+    def server_delete(self, sid):
+        return self._api(self._rack_by_sid(sid)).call('server_delete', sid)
+
+    def rack_discover(self, switch_name, ip, create):
+        _, rack_name = server_helper.switch_name_parse(switch_name)
+        return self._api(rack_name).call(
+            'rack_discover', switch_name, ip, create)
+
+    def dhcp_rack_update(self, rack_name):
+        self.dhcp.ensure_subnets(self.db.subnets_get(rack_name))
+
+    def dhcp_allocate_many(self, rack_name, requests):
+        """ Serve DHCPProxy.allocate_many of shard processes
+        :param requests: (subnet_id, serial, mac, ip) for every port
+        :type requests: list of tuple
+        :rtype: list of str
+        """
+        rack = self.db.rack_get(name=rack_name)
+        nets = self.db.subnets_get_by(id=list(set(r[0] for r in requests)))
+        nets = dict((net.id, net) for net in nets)
+        return self.dhcp.allocate_many(
+            rack, [(nets[net_id], serial, mac, ip)
+                   for net_id, serial, mac, ip in requests])
+
+    def dhcp_delete_for_serial(self, serial, ignored):
+        return self.dhcp.delete_for_serial(serial, ignored)
+
+    def dhcp_ensure_subnets(self, net_ids):
+        return self.dhcp.ensure_subnets(self.db.subnets_get_by(id=net_ids))
+
+    def rack_renumber(self, rack_name, fake):
+        return self._api(rack_name).call('rack_renumber', rack_name, fake)
+
+    def dhcp_hook(self, ipmi_ip, ipmi_mac, force=False):
+        return self._api(self._rack_by_ip(ipmi_ip)).send(
+            'dhcp_hook', ipmi_ip, ipmi_mac, force)
+
+    def discovery_cache_reset(self, ipmi_mac):
+        # Discovery cache is kept per process, so reset it everywhere
+        result = set()
+        for url in self.urls:
+            result.update(rpc.RPCApi(url).call('discovery_cache_reset',
+                                               ipmi_mac))
+        return result
+
+    def os_list(self, os_name):
+        return self._api(None).call('os_list', os_name)
+
+    @staticmethod
+    def health_check():
+        return {}
+
+    def sweep_stats(self):
+        return dict((shard, rpc.RPCApi(url).call('sweep_stats'))
+                    for shard, url in enumerate(self.urls))
+
+
+class Supervisor(object):
+    """
+    Start worker child processes, each one processing own shard of the
+    worker racks, and the router process. Died processes are respawned.
+    Supervisor itself does not use eventlet, so every child is forked from
+    a clean process.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.ring = sharding.HashRing(range(processes))
+        # pid: shard, None for router
+        self.children = dict()
+        self.urls = [None] * processes
+
+    def run(self):
+        # Ensure worker record exists before children are started
+        db_api.Driver().worker_register(CONF.worker.name, '',
+                                        CONF.common.location)
+        signal.signal(signal.SIGTERM, self._terminate)
+        for shard in range(self.processes):
+            self._start(shard)
+        self._start(None)
+        while True:
+            pid, status = os.wait()
+            if pid not in self.children:
+                continue
+            shard = self.children.pop(pid)
+            LOG.warning('Worker process %s (shard %s) exited with %s, '
+                        'restarting', pid, shard, status)
+            try:
+                self._start(shard)
+            except Exception:
+                LOG.warning(traceback.format_exc())
+                time.sleep(1)
+
+    def _start(self, shard):
+        """ Fork child process.
+        :param shard: shard number or None for router
+        """
+        # Connection pool can not be shared between processes
+        session_api.dispose_engine()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._run_child(shard, write_fd)
+            change_log.stop()
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            url = pipe.readline().strip()
+        if shard is not None:
+            self.urls[shard] = url
+        self.children[pid] = shard
+        LOG.info('Worker process %s started for shard %s: %s',
+                 pid, shard, url)
+
+    def _run_child(self, shard, write_fd):
+        from dao.control.worker import manager
+        try:
+            signal.signal(signal.SIGTERM, terminate)
+            if shard is None:
+                child = Router(self.ring, self.urls)
+            else:
+                child = manager.Manager(shard=shard, ring=self.ring)
+            with os.fdopen(write_fd, 'w') as pipe:
+                pipe.write(child.url + '\n')
+            eventlet.monkey_patch()
+            serve(child)
+        except Exception:
+            LOG.warning(traceback.format_exc())
+            change_log.stop()
+            os._exit(1)
+
+    def _terminate(self, signum, frame):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        os._exit(0)